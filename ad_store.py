@@ -0,0 +1,185 @@
+import glob
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+from tqdm import tqdm
+
+AD_STORE_PATH = "data/ads.sqlite"
+
+
+class AdStore:
+    """
+    Scraped ad details packed in a single SQLite file instead of one json file
+    per ad. Ads are stored as zlib compressed json in a table keyed by ad id, so
+    checking whether an ad was already scraped is an index lookup and the
+    cleaning stage can iterate over every ad with one sequential read.
+    A second table keeps the created/modified dates each listing had on the
+    last crawl, which drives incremental re-crawls, and whether it is still
+    listed. It is safe to share one store between threads.
+    """
+
+    def __init__(self, path=AD_STORE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ads ("
+            "id TEXT PRIMARY KEY, payload BLOB NOT NULL, scraped_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS listings ("
+            "id TEXT PRIMARY KEY, created TEXT, modified TEXT, status TEXT NOT NULL, "
+            "last_seen REAL NOT NULL, delisted_at REAL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _pack(ad):
+        return zlib.compress(json.dumps(ad, separators=(",", ":")).encode())
+
+    @staticmethod
+    def _unpack(payload):
+        return json.loads(zlib.decompress(payload))
+
+    def put(self, id, ad):
+        self.put_many([(id, ad)])
+
+    def put_many(self, ads):
+        """
+        :param ads: iterable of (id, ad) pairs, existing ads are replaced
+        """
+        now = time.time()
+        rows = [(str(id), self._pack(ad), now) for id, ad in ads]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO ads (id, payload, scraped_at) VALUES (?, ?, ?)",
+                rows,
+            )
+            self._conn.commit()
+
+    def get(self, id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload FROM ads WHERE id = ?", (str(id),)
+            ).fetchone()
+        return None if row is None else self._unpack(row[0])
+
+    def __contains__(self, id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM ads WHERE id = ?", (str(id),)
+            ).fetchone()
+        return row is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM ads").fetchone()[0]
+
+    def ids(self):
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT id FROM ads")}
+
+    def iter_ads(self):
+        """
+        :return: a generator over (id, ad) pairs read in id order
+        """
+        # A separate connection so that iterating doesn't hold the lock
+        conn = sqlite3.connect(self.path)
+        try:
+            rows = conn.execute("SELECT id, payload FROM ads ORDER BY id")
+            for id, payload in rows:
+                yield id, self._unpack(payload)
+        finally:
+            conn.close()
+
+    def listing_versions(self):
+        """
+        :return: a dict mapping the id of every known listing to its modified date
+        """
+        with self._lock:
+            return dict(self._conn.execute("SELECT id, modified FROM listings"))
+
+    def record_listings(self, listings):
+        """
+        :param listings: iterable of (id, created, modified) for listings seen on
+        the current crawl whose details are up to date in the store
+        """
+        now = time.time()
+        rows = [(str(id), created, modified, now) for id, created, modified in listings]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO listings "
+                "(id, created, modified, status, last_seen, delisted_at) "
+                "VALUES (?, ?, ?, 'active', ?, NULL)",
+                rows,
+            )
+            self._conn.commit()
+
+    def mark_delisted(self, listed_ids):
+        """
+        :param listed_ids: ids of every listing found by the current crawl
+        :return: the number of active listings that vanished and were marked delisted
+        """
+        with self._lock:
+            self._conn.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS listed (id TEXT PRIMARY KEY)"
+            )
+            self._conn.execute("DELETE FROM listed")
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO listed (id) VALUES (?)",
+                ((str(id),) for id in listed_ids),
+            )
+            cursor = self._conn.execute(
+                "UPDATE listings SET status = 'delisted', delisted_at = ? "
+                "WHERE status = 'active' AND id NOT IN (SELECT id FROM listed)",
+                (time.time(),),
+            )
+            self._conn.execute("DELETE FROM listed")
+            self._conn.commit()
+            return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def import_json_tree(store, pattern="data/ads/*.json", batch_size=1000):
+    """
+    Migrates ads saved as one json file each (data/ads/{id}.json) into the store.
+    Files already imported are skipped so the migration can be rerun.
+    :return: the number of ads imported
+    """
+    done = store.ids()
+    paths = [
+        path
+        for path in glob.glob(pattern)
+        if os.path.splitext(os.path.basename(path))[0] not in done
+    ]
+    batch = []
+    for path in tqdm(paths):
+        with open(path, "r") as f:
+            batch.append((os.path.splitext(os.path.basename(path))[0], json.load(f)))
+        if len(batch) == batch_size:
+            store.put_many(batch)
+            batch = []
+    if batch:
+        store.put_many(batch)
+    return len(paths)
+
+
+if __name__ == "__main__":
+    # python ad_store.py [json directory] [store path]
+    json_dir = sys.argv[1] if len(sys.argv) > 1 else "data/ads"
+    store_path = sys.argv[2] if len(sys.argv) > 2 else AD_STORE_PATH
+    ad_store = AdStore(store_path)
+    imported = import_json_tree(ad_store, os.path.join(json_dir, "*.json"))
+    print(f"Imported {imported} ads, {len(ad_store)} ads in {store_path}")
+    ad_store.close()
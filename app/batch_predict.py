@@ -0,0 +1,182 @@
+"""
+Prices every listing of a csv or Parquet file with the published models.
+
+Reads the listings in chunks of --chunk-size rows, scores each chunk with one
+vectorized prediction per model and appends the prices, with the same quantile
+repair and reliability score as the app, to the output file as chunks complete.
+With --workers processes, only a few chunks per worker are in flight, so memory
+stays bounded whatever the size of the file.
+
+    python batch_predict.py data/listings.parquet data/prices.parquet --workers 4
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from inference import load_models, score
+
+CHUNK_SIZE = 10000
+# Chunks queued per worker process
+CHUNKS_PER_WORKER = 2
+
+_models = None
+_pipeline = None
+_thread_count = -1
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE, columns=None):
+    """
+    :param columns: columns to read, every column if None
+    :return: an iterator over the listings of the csv or Parquet file path, in
+    frames of chunk_size rows
+    """
+    if path.endswith(".parquet"):
+        parquet_file = pq.ParquetFile(path)
+        if columns is not None:
+            columns = [x for x in columns if x in parquet_file.schema_arrow.names]
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    else:
+        usecols = None if columns is None else lambda x: x in columns
+        for chunk in pd.read_csv(path, chunksize=chunk_size, usecols=usecols):
+            yield chunk
+
+
+class PredictionWriter:
+    """
+    Appends the predictions of every chunk to a csv or Parquet file, written
+    under a temporary name and only moved to path once closed without error.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self._tmp_path = f"{path}.tmp"
+        self._writer = None
+
+    def write(self, predictions):
+        if self.path.endswith(".parquet"):
+            table = pa.Table.from_pandas(predictions, preserve_index=False)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self._tmp_path, table.schema)
+            self._writer.write_table(table)
+        else:
+            predictions.to_csv(
+                self._tmp_path, mode="a", header=self.rows == 0, index=False
+            )
+        self.rows += len(predictions)
+
+    def close(self, discard=False):
+        """
+        :param discard: remove the predictions written so far instead
+        """
+        if self._writer is not None:
+            self._writer.close()
+        if not os.path.exists(self._tmp_path):
+            return
+        if discard:
+            os.remove(self._tmp_path)
+        else:
+            os.replace(self._tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        self.close(discard=exc_type is not None)
+
+
+def init_worker(thread_count=-1):
+    """
+    Loads the models once per process.
+    """
+    global _models, _pipeline, _thread_count
+    _models, _pipeline = load_models()
+    _thread_count = thread_count
+
+
+def score_chunk(chunk):
+    """
+    :return: the id of every listing of chunk, if it has them, and its prices
+    """
+    predictions = score(chunk, _models, _pipeline, _thread_count)
+    if "id" in chunk.columns:
+        predictions.insert(0, "id", chunk["id"].to_numpy())
+    return predictions
+
+
+def score_chunks(chunks, workers=1):
+    """
+    :return: an iterator over the predictions of chunks, in order, scored by
+    workers processes sharing the cores, or by this process, whose models are
+    loaded by init_worker, if workers is 1
+    """
+    if workers == 1:
+        for chunk in chunks:
+            yield score_chunk(chunk)
+        return
+    thread_count = max(1, (os.cpu_count() or 1) // workers)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(thread_count,),
+    ) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(score_chunk, chunk))
+            if len(pending) >= CHUNKS_PER_WORKER * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def batch_predict(input_path, output_path, chunk_size=CHUNK_SIZE, workers=1):
+    """
+    Prices every listing of input_path and writes the predictions to
+    output_path, csv or Parquet.
+    :return: the number of listings priced
+    """
+    init_worker()
+    if _pipeline is not None:
+        columns = _pipeline.features
+    else:
+        columns = _models[0].feature_names_
+    chunks = read_chunks(input_path, chunk_size, columns + ["id"])
+    start = time.monotonic()
+    with PredictionWriter(output_path) as writer:
+        for predictions in score_chunks(chunks, workers):
+            writer.write(predictions)
+            logging.info(f"{writer.rows} listings priced")
+    elapsed = time.monotonic() - start
+    print(
+        f"{writer.rows} listings priced in {elapsed:.1f} s "
+        f"({writer.rows / max(elapsed, 1e-9):.0f} listings/s)"
+    )
+    return writer.rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("input", help="csv or Parquet file of listings")
+    parser.add_argument("output", help="csv or Parquet file of predictions")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    batch_predict(args.input, args.output, args.chunk_size, args.workers)
+
+
+if __name__ == "__main__":
+    main()
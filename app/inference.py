@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+from catboost import CatBoostRegressor, Pool
+
+from artifact_cache import get_artifact_cache
+from preprocessing import PreprocessingPipeline, fill_missing_categories
+from quantile_models import predict_quantiles, production_model_names
+from reliability import reliability_score
+
+# Parameters of the reliability_score shown in the app
+RELIABILITY_CENTER = 0.2
+RELIABILITY_SHAPE = 20
+
+
+def load_models(cache=None):
+    """
+    Loads the published models without Streamlit, for batch scoring and the
+    prediction service.
+    :return: (models, pipeline), pipeline None for models trained before
+    pipelines were saved
+    """
+    cache = cache or get_artifact_cache()
+    names = production_model_names(cache)
+    paths = cache.get_many([f"models/catboost_{name}.cbm" for name in names])
+    models = tuple(CatBoostRegressor().load_model(path) for path in paths.values())
+    try:
+        pipeline_path = cache.get(f"models/catboost_{names[0]}_preprocessing.json")
+    except FileNotFoundError:
+        return models, None
+    return models, PreprocessingPipeline.load(pipeline_path)
+
+
+def repair_quantiles(price_q1, price_q2, price_q3):
+    """
+    Reorders crossing quantiles like predict_price, on arrays: swapped q1 and q3
+    are put back in order and a median outside of them is replaced by their
+    midpoint.
+    :return: the repaired q1, q2 and q3
+    """
+    price_q1, price_q2, price_q3 = map(np.asarray, (price_q1, price_q2, price_q3))
+    swapped = price_q3 <= price_q1
+    crossing = (price_q1 >= price_q2) | (price_q2 >= price_q3)
+    midpoint = (price_q1 + price_q3) / 2
+    low = np.where(swapped, price_q3, price_q1)
+    high = np.where(swapped, price_q1, price_q3)
+    median = np.where(swapped | crossing, midpoint, price_q2)
+    return low, median, high
+
+
+def prepare_features(df, models, pipeline=None):
+    """
+    :param df: listings in the schema of the train set
+    :return: the features of the models, processed like the train set, with the
+    missing categories set to "nan"
+    """
+    if pipeline is not None:
+        df = pipeline.transform(df)
+    X = df.reindex(columns=models[0].feature_names_)
+    return fill_missing_categories(X, models[0].get_cat_feature_indices())
+
+
+def score(df, models, pipeline=None, thread_count=-1):
+    """
+    Prices every listing of df in one pass per model.
+    :param thread_count: CatBoost threads, every core if -1
+    :return: the repaired price_q1, price_q2 and price_q3 and the reliability
+    of every listing, indexed like df
+    """
+    X = prepare_features(df, models, pipeline)
+    pool = Pool(X, cat_features=models[0].get_cat_feature_indices())
+    predictions = predict_quantiles(models, pool, thread_count)
+    price_q1, price_q2, price_q3 = repair_quantiles(*predictions.T)
+    return pd.DataFrame(
+        {
+            "price_q1": price_q1,
+            "price_q2": price_q2,
+            "price_q3": price_q3,
+            "reliability": reliability_score(
+                price_q1, price_q2, price_q3, RELIABILITY_CENTER, RELIABILITY_SHAPE
+            ),
+        },
+        index=df.index,
+    )
@@ -6,30 +6,31 @@ from catboost import CatBoostRegressor, Pool
 import seaborn as sns
 import matplotlib.pyplot as plt
 from const import *
+from inference import predict_quantiles, prepare_features, repair_quantiles
 from threading import RLock
 import io
 
 
-def predict_price(df, q1, q2, q3):
-    price_q1 = q1.predict(df)[0]
-    price_q2 = q2.predict(df)[0]
-    price_q3 = q3.predict(df)[0]
-
-    if price_q3 <= price_q1:
-        return price_q3, (price_q1 + price_q3) / 2, price_q1
-    if (price_q1 >= price_q2) or (price_q2 >= price_q3):
-        return price_q1, (price_q3 + price_q1) / 2, price_q3
-
-    return price_q1, price_q2, price_q3
+def predict_price(df, *models):
+    """
+    :param models: a single MultiQuantile model predicting q1, q2 and q3 at once,
+    or the q1, q2 and q3 models
+    :return: the q1, q2 and q3 prices of the first row of df, repaired if they
+    cross
+    """
+    predictions = predict_quantiles(models, df)[0]
+    return tuple(float(x) for x in repair_quantiles(*predictions))
 
 
-def pdp_num(row, X_test_set, feature, models):
+def pdp_num(row, X_test_set, feature, models, pipeline=None):
     """
     Function to get partial dependency plot for a numerical feature.
-    :param row: item to be estimated processed for prediction
+    :param row: item to be estimated, as entered by the user
     :param X_test_set: test set
     :param feature: name of the feature on which to plot pdp
-    :param models: list of q1,q2,q3 models
+    :param models: list of q1,q2,q3 models, or of the single MultiQuantile model
+    :param pipeline: PreprocessingPipeline of the models, every value of the
+    feature is prepared like the estimated price, see prepare_features
     :return: plot of the influence of the feature on estimated price for the row in question
     """
 
@@ -44,7 +45,9 @@ def pdp_num(row, X_test_set, feature, models):
 
     for val in range_vals:
         row[feature] = val
-        pred1, pred2, pred3 = predict_price(row, models[0], models[1], models[2])
+        pred1, pred2, pred3 = predict_price(
+            prepare_features(row, models, pipeline), *models
+        )
         predictions_q1.append(pred1)
         predictions_q2.append(pred2)
         predictions_q3.append(pred3)
@@ -72,7 +75,7 @@ def pdp_num(row, X_test_set, feature, models):
     return img_base64
 
 
-def pdp_cat(row, X_test_set, feature, models):
+def pdp_cat(row, X_test_set, feature, models, pipeline=None):
     if feature == "fuel_type":
         range_vals = fuel_types
     elif feature == "number_plate_ending":
@@ -90,7 +93,9 @@ def pdp_cat(row, X_test_set, feature, models):
     vals = []
     for val in range_vals:
         row[feature] = val
-        pred_q1, pred_q2, pred_q3 = predict_price(row, models[0], models[1], models[2])
+        pred_q1, pred_q2, pred_q3 = predict_price(
+            prepare_features(row, models, pipeline), *models
+        )
         predictions_q1.append(pred_q1)
         predictions_q2.append(pred_q2)
         predictions_q3.append(pred_q3)
@@ -1,16 +1,16 @@
 import pickle
-from io import BytesIO
 from threading import RLock
-import os
 
 import numpy as np
 import pandas as pd
 import streamlit as st
-from catboost import Pool, CatBoostRegressor
-from google.cloud import storage
+from catboost import Pool
 
+from artifact_cache import get_artifact_cache
 from const import *
-from interpretability import pdp_cat, pdp_num
+from inference import load_models, prepare_features
+from interpretability import pdp_cat, pdp_num, predict_price
+from preprocessing import read_dataset
 from reliability import reliability_score
 from streamlit.runtime.scriptrunner import get_script_run_ctx
 
@@ -27,43 +27,31 @@ if "preds" not in st.session_state:
     st.session_state["preds"] = None
 if "reliability" not in st.session_state:
     st.session_state["reliability"] = None
-if "catboost_model_1" not in st.session_state:
-    st.session_state["catboost_model_1"] = None
+if "catboost_models" not in st.session_state:
+    st.session_state["catboost_models"] = None
 if "catboost_model" not in st.session_state:
     st.session_state["catboost_model"] = None
-if "catboost_model_3" not in st.session_state:
-    st.session_state["catboost_model_3"] = None
 
 
 @st.cache_resource(show_spinner=False)
-def load_model(name):
+def preload_models():
+    """
+    :return: the published models and their PreprocessingPipeline, loaded once
+    per process, see inference.load_models
+    """
     with _model_lock:
-        model_name = f"catboost_{name}.cbm"
-        if not os.path.exists(model_name):
-            client = storage.Client()
-            bucket = client.get_bucket("price-estimation")
-            blob = bucket.blob(f"models/catboost_{name}.cbm")
-            blob.download_to_filename(model_name)
+        return load_models()
 
-        cb = CatBoostRegressor().load_model(model_name)
-    return cb
 
-@st.cache_resource(show_spinner=False)
-def preload_models():
-    model_1 = load_model("q1")
-    model_2 = load_model("q2")
-    model_3 = load_model("q3")
-    return model_1, model_2, model_3
-
-if not all([
-    st.session_state["catboost_model_1"],
-    st.session_state["catboost_model"],
-    st.session_state["catboost_model_3"]
-]):
-    catboost_model_1,catboost_model , catboost_model_3 = preload_models()
-    st.session_state["catboost_model_1"] = catboost_model_1
-    st.session_state["catboost_model"] = catboost_model
-    st.session_state["catboost_model_3"] = catboost_model_3
+def set_models():
+    catboost_models, pipeline = preload_models()
+    st.session_state["catboost_models"] = catboost_models
+    st.session_state["catboost_model"] = catboost_models[len(catboost_models) // 2]
+    return pipeline
+
+
+if not all([st.session_state["catboost_models"], st.session_state["catboost_model"]]):
+    set_models()
 
 user_agent = st.request.headers.get("User-Agent", "") if hasattr(st, "request") else ""
 if "Google-Cloud-Scheduler" in user_agent:
@@ -72,43 +60,32 @@ if "Google-Cloud-Scheduler" in user_agent:
 
 @st.cache_data(show_spinner=False)
 def load_car_dictionnary():
-    client = storage.Client()
-    bucket = client.get_bucket("price-estimation")
-    blob = bucket.blob("data/car_dictionary.pkl")
-    dict_name = "car_dictionary.pkl"
-    blob.download_to_filename(dict_name)
-    with open(dict_name, "rb") as f:
+    dict_path = get_artifact_cache().get("data/car_dictionary.pkl")
+    with open(dict_path, "rb") as f:
         cars_dict = pickle.load(f)
     return cars_dict
 
 
 @st.cache_data(show_spinner=False)
-def load_test_set():
-    client = storage.Client()
-    bucket = client.get_bucket("price-estimation")
-    blob_test = bucket.get_blob("data/train_test_sets/test_02032024.csv")
-    test_bytes = blob_test.download_as_bytes()
-    test = pd.read_csv(BytesIO(test_bytes), index_col=0)
-    return test
+def load_test_set(columns=None):
+    """
+    :param columns: columns to read from the typed Parquet test set, every
+    column if None
+    """
+    cache = get_artifact_cache()
+    try:
+        test_path = cache.get("data/train_test_sets/test_02032024.parquet")
+    except FileNotFoundError:
+        test_path = cache.get("data/train_test_sets/test_02032024.csv")
+        test = pd.read_csv(test_path, index_col=0)
+        return test if columns is None else test[columns]
+    return read_dataset(test_path, columns)
 
 
 def create_dict_for_pred(model):
     return {k: np.nan for k in model.feature_names_}
 
 
-def predict_price(df, q1, q2, q3):
-    price_q1 = q1.predict(df)[0]
-    price_q2 = q2.predict(df)[0]
-    price_q3 = q3.predict(df)[0]
-
-    if price_q3 <= price_q1:
-        return price_q3, (price_q1 + price_q3) / 2, price_q1
-    if (price_q1 >= price_q2) or (price_q2 >= price_q3):
-        return price_q1, (price_q3 + price_q1) / 2, price_q3
-
-    return price_q1, price_q2, price_q3
-
-
 cars_dict = load_car_dictionnary()
 
 st.title(":car: AI powered Used Car Price Estimator")
@@ -295,21 +272,18 @@ if st.button("Predict car price", use_container_width=True):
     st.session_state["reliability"] = None
     with st.spinner("Estimating car price..."):
 
-        catboost_model_1,catboost_model , catboost_model_3 = preload_models()
-
-        st.session_state["catboost_model_1"] = catboost_model_1
-        st.session_state["catboost_model"] = catboost_model
-        st.session_state["catboost_model_3"] = catboost_model_3
-
-        feature_names = catboost_model.feature_names_
-        df_input = pd.DataFrame([user_input], columns=feature_names)
+        pipeline = set_models()
+        catboost_model = st.session_state["catboost_model"]
+        df_input = prepare_features(
+            pd.DataFrame([user_input]), st.session_state["catboost_models"], pipeline
+        )
 
         st.session_state["df_input"] = df_input
 
         df_pool = Pool(df_input, cat_features=catboost_model.get_cat_feature_indices())
 
         price_q1, price_q2, price_q3 = predict_price(
-            df_pool, catboost_model_1, catboost_model, catboost_model_3
+            df_pool, *st.session_state["catboost_models"]
         )
         st.session_state["preds"] = (price_q1, price_q2, price_q3)
         reliability = reliability_score(price_q1, price_q2, price_q3, 0.2, 20)
@@ -364,19 +338,15 @@ user_input_effect = st.selectbox(
 _lock = RLock()
 with _lock:
     if st.button("Show the effect!"):
-        test_set = load_test_set()
+        test_set = load_test_set([user_input_effect])
         st.session_state["test_set"] = test_set
 
         test_set = st.session_state["test_set"]
-        df_input = pd.DataFrame(
-            [st.session_state["user_input"]],
-            columns=st.session_state["df_input"].columns,
-        )
-        st.session_state["df_input"] = df_input
+        # The effect goes through the same preparation as the estimated price
+        pipeline = set_models()
+        df_input = pd.DataFrame([st.session_state["user_input"]])
 
-        catboost_model_1 = st.session_state["catboost_model_1"]
-        catboost_model_2 = st.session_state["catboost_model"]
-        catboost_model_3 = st.session_state["catboost_model_3"]
+        catboost_models = list(st.session_state["catboost_models"])
 
         if isinstance(df_input[user_input_effect].values[0], float) or isinstance(
             df_input[user_input_effect].values[0], int
@@ -385,7 +355,8 @@ with _lock:
                 df_input,
                 test_set,
                 user_input_effect,
-                [catboost_model_1, catboost_model_2, catboost_model_3],
+                catboost_models,
+                pipeline,
             )
 
         else:
@@ -393,7 +364,8 @@ with _lock:
                 df_input,
                 test_set,
                 user_input_effect,
-                [catboost_model_1, catboost_model_2, catboost_model_3],
+                catboost_models,
+                pipeline,
             )
 
         img_src = f"data:image/png;base64,{fig}"
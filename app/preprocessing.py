@@ -0,0 +1,418 @@
+import json
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import infer_dtype, is_float_dtype
+
+# Bump when the preprocessing code changes to invalidate cached processed sets
+PREPROCESSING_VERSION = 1
+TARGET = "raw_price"
+UNWANTED_COLUMNS = [
+    "uuid",
+    "label",
+    "model_stub",
+    "thumbs",
+    "price_debatable",
+    "user_id",
+    "title",
+    "without_vat",
+    "seller",
+    "created",
+    "seo_json_ld",
+    "address_long",
+    "modified",
+    "battery_range",
+    "variant",
+    "trim",
+    "id",
+    "descriptive_title",
+    "description",
+]
+UNPRACTICAL_COLUMNS = [
+    "kteo",
+    "emissions_co2",
+    "battery_charge_time",
+    "vehicle_width",
+    "vehicle_height",
+    "vehicle_length",
+    "wheelbase",
+    "torque",
+    "acceleration",
+    "number_of_gears",
+    "gross_weight",
+    "top_speed",
+    "fuel_consumption",
+    "registration_month",
+]
+DECIMAL_COMMA_COLUMNS = ["fuel_consumption", "acceleration"]
+FLOAT_COLUMNS = ["battery_charge_time", "registration_year"]
+STRATEGIES = [
+    "all_extras",
+    "options",
+    "remove_outliers",
+    "drop_extras_and_options",
+    "drop_unpractical",
+    "drop_low_importance",
+    "impute_missing_values",
+]
+IMPUTATION_LEVELS = [
+    ["brand", "model", "registration_year"],
+    ["brand", "model"],
+    ["brand"],
+]
+# Numerical columns holding a small set of values, imputed with a mode
+DISCRETE_FEATURES = ["seats", "doors", "number_of_gears", "rim_size"]
+
+
+def is_categorical(series):
+    return series.name in DISCRETE_FEATURES or series.dtype in [
+        "object",
+        "bool",
+        "int64",
+        "category",
+    ]
+
+
+def group_modes(df, features, levels):
+    """
+    Counts the values of every feature once per group of the finest level, then
+    sums the counts up the hierarchy instead of regrouping the frame.
+    :param levels: lists of group columns, from the finest to the coarsest
+    :return: for every level a frame indexed by its group columns with the most
+    frequent value of every feature in the group, the smallest one on ties like
+    Series.mode, and a series of the modes over the whole frame
+    """
+    tables = [[] for _ in levels]
+    modes = {}
+    for feature in features:
+        counts = df.groupby(
+            levels[0] + [feature], observed=True, dropna=False, sort=True
+        ).size()
+        counts = counts[counts.index.get_level_values(feature).notna()]
+        for keys, table in zip(levels, tables):
+            counts = counts.groupby(
+                level=keys + [feature], observed=True, dropna=False
+            ).sum()
+            known = counts.index.to_frame(index=False)[keys].notna().all(axis=1)
+            table.append(group_argmax(counts[known.to_numpy()], keys, feature))
+        counts = counts.groupby(level=feature, observed=True).sum()
+        modes[feature] = counts.idxmax() if len(counts) else np.nan
+    tables = [pd.concat(table, axis=1) if table else None for table in tables]
+    return tables, pd.Series(modes, dtype=object)
+
+
+def group_argmax(counts, keys, feature):
+    # counts is sorted by keys then value, a stable sort on the count keeps the
+    # smallest value first among the most frequent ones
+    counts = counts.sort_values(ascending=False, kind="stable").reset_index()
+    counts = counts.drop_duplicates(keys)
+    return counts.set_index(keys)[feature]
+
+
+def group_means(df, features, levels):
+    """
+    Sums and counts every feature once per group of the finest level, then sums
+    them up the hierarchy instead of regrouping the frame.
+    :return: for every level a frame indexed by its group columns with the mean
+    of every feature in the group, and a series of the means over the whole frame
+    """
+    if not features:
+        return [None for _ in levels], pd.Series(dtype=float)
+    groups = df.groupby(levels[0], observed=True, dropna=False)[features]
+    sums, counts = groups.sum(), groups.count()
+    tables = []
+    for keys in levels:
+        sums = sums.groupby(level=keys, observed=True, dropna=False).sum()
+        counts = counts.groupby(level=keys, observed=True, dropna=False).sum()
+        known = sums.index.to_frame(index=False)[keys].notna().all(axis=1)
+        tables.append((sums / counts.where(counts > 0))[known.to_numpy()])
+    return tables, sums.sum() / counts.sum().where(counts.sum() > 0)
+
+
+def lookup(table, keys_frame):
+    """
+    :return: the rows of table matching every row of keys_frame, NaN if the
+    group wasn't seen during fit
+    """
+    if keys_frame.shape[1] > 1:
+        index = pd.MultiIndex.from_frame(keys_frame)
+    else:
+        index = pd.Index(keys_frame.iloc[:, 0])
+    return table.reindex(index)
+
+
+def fill(series, missing, values):
+    """
+    :return: series with the missing rows replaced by values, a series aligned
+    on it or a scalar, adding the new categories of categorical series
+    """
+    if isinstance(values, pd.Series):
+        values = values.to_numpy()
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        used = values[missing.to_numpy()] if np.ndim(values) else [values]
+        new = pd.Index(used).dropna().unique().difference(series.cat.categories)
+        series = series.cat.add_categories(new)
+    return series.mask(missing, values)
+
+
+def empty_table(keys):
+    """
+    :return: the lookup table of a level when no feature is imputed
+    """
+    return pd.DataFrame(index=pd.MultiIndex.from_tuples([], names=keys))
+
+
+class GroupImputer:
+    """
+    Imputes missing values with the mode of categorical features or the mean of
+    numerical ones among similar cars, going one level up the hierarchy
+    (brand/model/registration_year, brand/model then brand) while the group
+    has no value, and falling back on the whole train set.
+    fit computes the lookup tables of every level in a few vectorized passes, so
+    the test set and live predictions are imputed by joining on them.
+    """
+
+    def __init__(self, levels=IMPUTATION_LEVELS):
+        self.levels = levels
+        self.features = []
+        self.bool_features = []
+        self.tables = []
+        self.fill_values = pd.Series(dtype=object)
+
+    def fit(self, df, features=None):
+        """
+        :param features: columns to impute, the ones with missing values in df
+        if None, except the group columns which are left as they are
+        """
+        if features is None:
+            group_cols = {x for keys in self.levels for x in keys}
+            features = [x for x in df.columns[df.isna().any()] if x not in group_cols]
+        categorical = [x for x in features if is_categorical(df[x])]
+        numerical = [x for x in features if x not in categorical]
+        print(
+            f"Fitting imputation of {len(categorical)} categorical "
+            f"and {len(numerical)} numerical features"
+        )
+
+        mode_tables, modes = group_modes(df, categorical, self.levels)
+        mean_tables, means = group_means(df, numerical, self.levels)
+        self.tables = [
+            (
+                pd.concat([x for x in tables if x is not None], axis=1)[features]
+                if features
+                else empty_table(keys)
+            )
+            for keys, *tables in zip(self.levels, mode_tables, mean_tables)
+        ]
+        self.fill_values = pd.concat([modes, means.astype(object)])[features]
+        self.features = features
+        self.bool_features = [x for x in categorical if df[x].eq(True).any()]
+        return self
+
+    def transform(self, df):
+        """
+        :return: a copy of df with the missing values of the fitted features
+        imputed, imputed columns are replaced and the others shared with df
+        """
+        df = df.copy(deep=False)
+        features = [x for x in self.features if x in df.columns]
+        for keys, table in zip(self.levels, self.tables):
+            missing = df[features].isna()
+            features = missing.columns[missing.any()].tolist()
+            if not features:
+                break
+            values = lookup(table[features], df[keys])
+            for feature in features:
+                df[feature] = fill(df[feature], missing[feature], values[feature])
+        for feature in features:
+            df[feature] = fill(
+                df[feature], df[feature].isna(), self.fill_values[feature]
+            )
+
+        for feature in self.bool_features:
+            if feature in df.columns:
+                df[feature] = df[feature].astype(bool)
+        return df
+
+    def fit_transform(self, df, features=None):
+        return self.fit(df, features).transform(df)
+
+    def to_dict(self):
+        return {
+            "levels": self.levels,
+            "features": self.features,
+            "bool_features": self.bool_features,
+            "tables": [
+                table.reset_index().to_dict(orient="split", index=False)
+                for table in self.tables
+            ],
+            "fill_values": self.fill_values.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        imputer = cls(state["levels"])
+        imputer.features = state["features"]
+        imputer.bool_features = state["bool_features"]
+        imputer.tables = [
+            pd.DataFrame(table["data"], columns=table["columns"]).set_index(keys)
+            for keys, table in zip(imputer.levels, state["tables"])
+        ]
+        imputer.fill_values = pd.Series(state["fill_values"], dtype=object)
+        return imputer
+
+
+def fill_missing_categories(X, categorical_features):
+    """
+    :param categorical_features: positions of the categorical features in X
+    :return: X with the missing values of the categorical features set to "nan"
+    and the categories read as floats, integers with some missing, cast back to
+    integers or to strings, as CatBoost rejects float categories
+    """
+    X = X.copy()
+    for column in X.columns[categorical_features]:
+        if is_float_dtype(X[column]):
+            X[column] = pd.Series(
+                [int(x) if x % 1 == 0 else str(x) for x in X[column]],
+                index=X.index,
+                dtype=object,
+            )
+        if isinstance(X[column].dtype, pd.CategoricalDtype):
+            if "nan" not in X[column].cat.categories:
+                X[column] = X[column].cat.add_categories("nan")
+        X[column] = X[column].fillna("nan")
+    return X
+
+
+def process_types(data_set):
+    # Typed datasets already hold floats, only csv data needs parsing
+    for column in DECIMAL_COMMA_COLUMNS:
+        if column in data_set.columns and not is_float_dtype(data_set[column]):
+            data_set[column] = (
+                data_set[column].astype(str).str.replace(",", ".").astype(float)
+            )
+    for column in FLOAT_COLUMNS:
+        if column in data_set.columns and not is_float_dtype(data_set[column]):
+            data_set[column] = data_set[column].astype(float)
+    return data_set
+
+
+def normalize_types(df):
+    """
+    Coerces a frame parsed from csv to the types of the datasets: comma decimals
+    as floats, object columns holding only booleans as bools (kept as object if
+    they have missing values, stored as nullable booleans) and other text
+    columns as categoricals, stored dictionary encoded.
+    """
+    df = process_types(df.copy())
+    for column in df.columns[df.dtypes == object]:
+        kind = infer_dtype(df[column], skipna=True)
+        if kind == "boolean" and df[column].notna().all():
+            df[column] = df[column].astype(bool)
+        elif kind == "string":
+            df[column] = df[column].astype("category")
+    return df
+
+
+def write_dataset(df, path):
+    """
+    Saves a frame, normalized with normalize_types, as a typed Parquet file.
+    """
+    df.to_parquet(path, engine="pyarrow", compression="zstd")
+    return path
+
+
+def read_dataset(path, columns=None):
+    """
+    :param path: Parquet file path or file-like object
+    :param columns: columns to read, every column if None
+    """
+    return pd.read_parquet(path, engine="pyarrow", columns=columns)
+
+
+def strategy_dropped_columns(columns, strategy, low_importances=()):
+    """
+    :return: the columns the strategy leaves out of the model
+    """
+    options = [x for x in columns if "option" in x]
+    extras = [x for x in columns if "extra" in x]
+    if strategy in ["all_extras", "remove_outliers"]:
+        return options
+    if strategy == "options":
+        return extras
+    if strategy == "drop_extras_and_options":
+        return options + extras
+    if strategy == "drop_unpractical":
+        return UNPRACTICAL_COLUMNS + options
+    if strategy == "drop_low_importance":
+        return list(low_importances)
+    if strategy == "impute_missing_values":
+        return ["kteo", "battery_charge_time"] + options
+    raise ValueError(f"Unknown strategy {strategy}, expected one of {STRATEGIES}")
+
+
+class PreprocessingPipeline:
+    """
+    Preprocessing of a strategy, fitted on the train set and saved next to the
+    model so the app transforms its inputs exactly like the train and test sets:
+    - keeps the columns of the strategy, in the order the model was trained on,
+    - coerces the types process_types fixes,
+    - imputes missing values with a GroupImputer for impute_missing_values.
+    The state is saved as plain json and doesn't depend on the training code.
+    """
+
+    def __init__(self, strategy):
+        self.strategy = strategy
+        self.features = []
+        self.imputer = None
+
+    def fit(self, df, low_importances=()):
+        """
+        :param low_importances: columns dropped by drop_low_importance
+        """
+        print(f"Fitting preprocessing for strategy {self.strategy}")
+        columns = [x for x in df.columns if x not in UNWANTED_COLUMNS]
+        dropped = set(strategy_dropped_columns(columns, self.strategy, low_importances))
+        self.features = [x for x in columns if x not in dropped and x != TARGET]
+        self.imputer = None
+        if self.strategy == "impute_missing_values":
+            self.imputer = GroupImputer().fit(self.transform(df))
+        return self
+
+    def transform(self, df):
+        """
+        :return: the features of df in the order of the fit, plus the target if
+        df has it, with missing feature columns added empty
+        """
+        columns = self.features + [TARGET] if TARGET in df.columns else self.features
+        df = process_types(df.reindex(columns=columns))
+        if self.imputer is not None:
+            df = self.imputer.transform(df)
+        return df
+
+    def fit_transform(self, df, low_importances=()):
+        return self.fit(df, low_importances).transform(df)
+
+    def to_dict(self):
+        state = {"strategy": self.strategy, "features": self.features}
+        if self.imputer is not None:
+            state["imputer"] = self.imputer.to_dict()
+        return state
+
+    @classmethod
+    def from_dict(cls, state):
+        pipeline = cls(state["strategy"])
+        pipeline.features = state["features"]
+        if "imputer" in state:
+            pipeline.imputer = GroupImputer.from_dict(state["imputer"])
+        return pipeline
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
@@ -0,0 +1,32 @@
+import numpy as np
+
+from artifact_cache import get_artifact_cache
+
+MULTIQUANTILE_MODEL = "models/catboost_multiquantile.cbm"
+
+
+def production_model_names(cache=None):
+    """
+    :return: the names of the models served by the app, the single MultiQuantile
+    model when it is published, which train_final_models only does once it
+    matches the three model baseline, the q1, q2 and q3 models otherwise
+    """
+    cache = cache or get_artifact_cache()
+    try:
+        cache.get(MULTIQUANTILE_MODEL)
+    except FileNotFoundError:
+        return ["q1", "q2", "q3"]
+    return ["multiquantile"]
+
+
+def predict_quantiles(models, data, thread_count=-1):
+    """
+    :param models: a single MultiQuantile model or the q1, q2 and q3 models
+    :param thread_count: CatBoost threads, every core if -1
+    :return: the predictions of data, one column per quantile
+    """
+    if len(models) == 1:
+        return models[0].predict(data, thread_count=thread_count)
+    return np.column_stack(
+        [model.predict(data, thread_count=thread_count) for model in models]
+    )
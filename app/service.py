@@ -0,0 +1,233 @@
+"""
+JSON prediction service, pricing listings without a Streamlit session.
+
+    POST /predict {"listing": {...}}      -> {"price_q1": ..., "price_q2": ...,
+                                              "price_q3": ..., "reliability": ...}
+    POST /predict {"listings": [{...}]}   -> {"predictions": [{...}, ...]}
+    GET /health                           -> {"status": "ok", "models": 1}
+
+Listings have the fields of the app form. Categorical fields are checked
+against the lists of const.py and numeric and boolean fields against their
+types, invalid listings are answered with a 400 listing the errors.
+
+    python service.py --port 8081
+"""
+
+import argparse
+import json
+import logging
+import numbers
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+from const import *
+from inference import load_models, score
+
+CATEGORY_VALUES = {
+    "fuel_type": fuel_types,
+    "gearbox_type": gearbox_types,
+    "interior_type": interior_types,
+    "exterior_color": exterior_colors,
+    "interior_color": interior_colors,
+    "number_plate_ending": number_plate_endings,
+    "drive_type": drive_types,
+    "body_type": body_types,
+}
+NUMERIC_FIELDS = [
+    "mileage",
+    "engine_size",
+    "registration_year",
+    "engine_power",
+    "seats",
+    "doors",
+    "rim_size",
+    "lat",
+    "lon",
+]
+BOOLEAN_FIELDS = ["is_new", "crashed", "never_crashed", "is_metallic"]
+# Defaults of the app form
+DEFAULTS = {"lat": lat, "lon": longitude}
+MAX_BATCH_SIZE = 10000
+MAX_BODY_BYTES = 50 * 1024 * 1024
+
+
+def validate_listing(listing):
+    """
+    :return: the errors of the listing, empty if it is valid. Missing and null
+    fields are valid, the models handle missing values.
+    """
+    if not isinstance(listing, dict):
+        return ["a listing must be a JSON object"]
+    errors = []
+    for field, value in listing.items():
+        if value is None:
+            continue
+        if field in CATEGORY_VALUES:
+            if value not in CATEGORY_VALUES[field]:
+                errors.append(f"{field} must be one of {CATEGORY_VALUES[field]}")
+        elif field in NUMERIC_FIELDS:
+            if isinstance(value, bool) or not isinstance(value, numbers.Real):
+                errors.append(f"{field} must be a number")
+        elif field in BOOLEAN_FIELDS or field.startswith("extra_"):
+            if not isinstance(value, bool):
+                errors.append(f"{field} must be a boolean")
+        elif field in ["brand", "model"]:
+            if not isinstance(value, str):
+                errors.append(f"{field} must be a string")
+    return errors
+
+
+class PredictionService:
+    """
+    HTTP server answering the prediction requests from threads, the models
+    being loaded once and shared: CatBoost releases the GIL while predicting,
+    so concurrent requests run in parallel. Each request predicts with
+    thread_count CatBoost threads. The service holds no state between
+    requests.
+    """
+
+    def __init__(
+        self, models=None, pipeline=None, host="0.0.0.0", port=8081, thread_count=1
+    ):
+        if models is None:
+            models, pipeline = load_models()
+        self.models = models
+        self.pipeline = pipeline
+        self.thread_count = thread_count
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def _handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.reply(*service.respond("GET", self.path, None))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                if length > MAX_BODY_BYTES:
+                    self.close_connection = True
+                    self.reply(413, {"error": "request body too large"})
+                    return
+                self.reply(*service.respond("POST", self.path, self.rfile.read(length)))
+
+            def reply(self, status, body):
+                body = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def predict(self, listings):
+        """
+        :param listings: valid listings, see validate_listing
+        :return: the prices and reliability of every listing
+        """
+        df = pd.DataFrame([{**DEFAULTS, **listing} for listing in listings])
+        predictions = score(df, self.models, self.pipeline, self.thread_count)
+        return predictions.to_dict(orient="records")
+
+    def respond(self, method, path, body):
+        """
+        :param body: raw body of a POST request
+        :return: (status, json body) answered to the request
+        """
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok", "models": len(self.models)}
+        if method != "POST" or path != "/predict":
+            return 404, {"error": f"{method} {path} not found"}
+        try:
+            request = json.loads(body)
+        except ValueError:
+            return 400, {"error": "body must be JSON"}
+        if isinstance(request, dict) and "listing" in request:
+            listings = [request["listing"]]
+        elif isinstance(request, dict) and isinstance(request.get("listings"), list):
+            listings = request["listings"]
+        else:
+            return 400, {"error": 'body must have a "listing" or "listings" field'}
+        if not 0 < len(listings) <= MAX_BATCH_SIZE:
+            return 400, {"error": f"listings must hold 1 to {MAX_BATCH_SIZE} items"}
+
+        errors = {}
+        for i, listing in enumerate(listings):
+            listing_errors = validate_listing(listing)
+            if listing_errors:
+                errors[i] = listing_errors
+        if errors:
+            if "listing" in request:
+                return 400, {"errors": errors[0]}
+            return 400, {"errors": {str(i): e for i, e in errors.items()}}
+
+        start = time.perf_counter()
+        try:
+            predictions = self.predict(listings)
+        except Exception as e:
+            logging.exception("Prediction failed")
+            return 500, {"error": str(e)}
+        logging.debug(
+            f"{len(listings)} listings priced in "
+            f"{(time.perf_counter() - start) * 1e3:.1f} ms"
+        )
+        if "listing" in request:
+            return 200, predictions[0]
+        return 200, {"predictions": predictions}
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        """
+        Serves from a background thread, until stop.
+        """
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8081)))
+    parser.add_argument("--thread-count", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    service = PredictionService(
+        host=args.host, port=args.port, thread_count=args.thread_count
+    )
+    logging.info(f"Serving predictions on {service.url}")
+    service.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
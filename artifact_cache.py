@@ -0,0 +1,380 @@
+import hashlib
+import logging
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import storage
+from google.cloud.storage import transfer_manager
+
+BUCKET = "price-estimation"
+CACHE_DIR = os.environ.get(
+    "ARTIFACT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", BUCKET)
+)
+MAX_CACHE_BYTES = int(float(os.environ.get("ARTIFACT_CACHE_MAX_BYTES", 5e9)))
+DOWNLOAD_WORKERS = 8
+UPLOAD_WORKERS = 4
+# Files above this size are uploaded in chunks sent concurrently
+MULTIPART_UPLOAD_BYTES = 64 * 1024 * 1024
+UPLOAD_CHUNK_BYTES = 32 * 1024 * 1024
+
+
+class GcsBackend:
+    """
+    Artifacts stored in a GCS bucket, versioned by blob generation. Large files
+    are uploaded as concurrent chunks.
+    """
+
+    def __init__(self, bucket_name=BUCKET, client=None):
+        self.bucket_name = bucket_name
+        self._client = client
+        self._bucket = None
+        self._lock = threading.Lock()
+
+    @property
+    def bucket(self):
+        with self._lock:
+            if self._bucket is None:
+                client = self._client or storage.Client()
+                self._bucket = client.bucket(self.bucket_name)
+            return self._bucket
+
+    def stat(self, name):
+        """
+        :return: the generation of the blob, None if it doesn't exist. Only
+        fetches the blob metadata.
+        """
+        blob = self.bucket.get_blob(name)
+        return None if blob is None else str(blob.generation)
+
+    def download(self, name, version, path):
+        blob = self.bucket.blob(name, generation=int(version))
+        blob.download_to_filename(path)
+
+    def upload(self, name, path):
+        blob = self.bucket.blob(name)
+        if os.path.getsize(path) > MULTIPART_UPLOAD_BYTES:
+            transfer_manager.upload_chunks_concurrently(
+                path,
+                blob,
+                chunk_size=UPLOAD_CHUNK_BYTES,
+                worker_type=transfer_manager.THREAD,
+            )
+        else:
+            blob.upload_from_filename(path)
+
+
+class LocalBackend:
+    """
+    Artifacts stored in a local directory mirroring the bucket layout, versioned
+    by modification time and size. Stands in for the bucket in tests and offline
+    development.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def stat(self, name):
+        path = os.path.join(self.root, name)
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+    def download(self, name, version, path):
+        if self.stat(name) != version:
+            raise FileNotFoundError(f"Version {version} of {name} is gone")
+        shutil.copyfile(os.path.join(self.root, name), path)
+
+    def upload(self, name, path):
+        target = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp_path = f"{target}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, target)
+
+
+_default_backend = None
+_default_backend_lock = threading.Lock()
+
+
+def default_backend():
+    """
+    :return: the backend shared by the process, a LocalBackend on
+    ARTIFACT_BACKEND_DIR if it is set, the bucket otherwise
+    """
+    global _default_backend
+    with _default_backend_lock:
+        if _default_backend is None:
+            root = os.environ.get("ARTIFACT_BACKEND_DIR")
+            _default_backend = LocalBackend(root) if root else GcsBackend()
+        return _default_backend
+
+
+class ArtifactCache:
+    """
+    Local cache of the bucket artifacts (datasets, models, dictionaries).
+    Every artifact version is stored once under a path derived from its name and
+    version (blob generation), so a new upload is never shadowed by a stale local
+    copy: get checks the current version with a metadata only lookup and only
+    downloads versions it doesn't hold yet. Downloads go to a temporary file
+    renamed into place, so readers never see a partial file, and run in parallel
+    with get_many. The least recently used versions are evicted past max_bytes.
+    When the backend can't be reached, or with offline=True, the latest cached
+    version is used.
+    The index is a SQLite file shared by the threads and processes using the
+    cache directory.
+    """
+
+    def __init__(
+        self,
+        backend=None,
+        directory=CACHE_DIR,
+        max_bytes=MAX_CACHE_BYTES,
+        offline=os.environ.get("ARTIFACT_CACHE_OFFLINE") == "1",
+    ):
+        self.backend = backend if backend is not None else default_backend()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.offline = offline
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(directory, "index.sqlite"),
+            check_same_thread=False,
+            timeout=60,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS artifacts ("
+            "name TEXT NOT NULL, version TEXT NOT NULL, path TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL, "
+            "PRIMARY KEY (name, version))"
+        )
+        self._conn.commit()
+
+    def _object_path(self, name, version):
+        digest = hashlib.sha1(f"{name}@{version}".encode()).hexdigest()
+        return os.path.join(
+            self.directory, "objects", f"{digest}{os.path.splitext(name)[1]}"
+        )
+
+    def _cached(self, name, version=None):
+        """
+        :return: the path of the cached version of name, the latest one if
+        version is None, None if it isn't cached
+        """
+        with self._lock:
+            if version is None:
+                row = self._conn.execute(
+                    "SELECT version, path FROM artifacts WHERE name = ? "
+                    "ORDER BY last_used DESC LIMIT 1",
+                    (name,),
+                ).fetchone()
+            else:
+                row = self._conn.execute(
+                    "SELECT version, path FROM artifacts "
+                    "WHERE name = ? AND version = ?",
+                    (name, version),
+                ).fetchone()
+            if row is None or not os.path.exists(row[1]):
+                return None
+            self._conn.execute(
+                "UPDATE artifacts SET last_used = ? WHERE name = ? AND version = ?",
+                (time.time(), name, row[0]),
+            )
+            self._conn.commit()
+            return row[1]
+
+    def version(self, name):
+        """
+        :return: the current version of name on the backend, None if it doesn't
+        exist there
+        """
+        return self.backend.stat(name)
+
+    def get(self, name):
+        """
+        :return: the local path of the current version of the artifact name
+        """
+        if self.offline:
+            version = None
+        else:
+            try:
+                version = self.backend.stat(name)
+            except Exception as e:
+                logging.warning(f"Can't check {name} ({e}), using the cached copy")
+                version = None
+            else:
+                if version is None:
+                    raise FileNotFoundError(f"Artifact {name} doesn't exist")
+        path = self._cached(name, version)
+        if path is not None:
+            return path
+        if version is None:
+            raise FileNotFoundError(f"Artifact {name} isn't cached")
+
+        path = self._object_path(name, version)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            self.backend.download(name, version, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?)",
+                (name, version, path, os.path.getsize(path), time.time()),
+            )
+            self._conn.commit()
+        logging.info(f"Downloaded {name} version {version}")
+        self.evict(keep=path)
+        return path
+
+    def get_many(self, names, max_workers=DOWNLOAD_WORKERS):
+        """
+        :return: a dict mapping every name to its local path, downloading them
+        in parallel
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(names, executor.map(self.get, names)))
+
+    def size(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM artifacts"
+            ).fetchone()[0]
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used versions until the cache fits in
+        max_bytes.
+        :param keep: path never evicted, the artifact just downloaded
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, version, path, size FROM artifacts "
+                "ORDER BY last_used DESC"
+            ).fetchall()
+            total = sum(row[3] for row in rows)
+            for name, version, path, size in reversed(rows):
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                self._conn.execute(
+                    "DELETE FROM artifacts WHERE name = ? AND version = ?",
+                    (name, version),
+                )
+                if os.path.exists(path):
+                    os.remove(path)
+                total -= size
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_artifact_cache():
+    """
+    :return: the ArtifactCache shared by the process, on CACHE_DIR
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = ArtifactCache()
+        return _default_cache
+
+
+class ArtifactPublisher:
+    """
+    Uploads artifacts in background threads so training goes on while models,
+    results and datasets are sent to the bucket. Uploads share the backend, and
+    with it one storage client and its connection pool. The queue is bounded:
+    publish blocks while max_pending uploads are waiting, so a slow network
+    can't pile up unbounded work. wait blocks until every upload published so
+    far is done and raises if any failed.
+    Files must not be modified once published.
+    """
+
+    def __init__(self, backend=None, workers=UPLOAD_WORKERS, max_pending=16):
+        self.backend = backend if backend is not None else default_backend()
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._lock = threading.Lock()
+        self._failures = []
+        self.uploaded = []
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            name, path, skip_existing = self._queue.get()
+            try:
+                if skip_existing and self.backend.stat(name) is not None:
+                    logging.info(f"{name} already published")
+                else:
+                    start = time.monotonic()
+                    self.backend.upload(name, path)
+                    logging.info(
+                        f"Published {name} ({os.path.getsize(path) / 1e6:.1f} MB) "
+                        f"in {time.monotonic() - start:.1f} s"
+                    )
+                    with self._lock:
+                        self.uploaded.append(name)
+            except Exception as e:
+                logging.error(f"Failed to publish {name}: {e}")
+                with self._lock:
+                    self._failures.append((name, e))
+            finally:
+                self._queue.task_done()
+
+    def publish(self, name, path, skip_existing=False):
+        """
+        Queues the upload of the local file path as the artifact name.
+        :param skip_existing: don't upload if the artifact already exists
+        """
+        self._queue.put((name, path, skip_existing))
+        return self
+
+    def wait(self):
+        """
+        Blocks until every published artifact is uploaded.
+        :raise RuntimeError: listing the artifacts that failed to upload
+        """
+        self._queue.join()
+        with self._lock:
+            failures, self._failures = self._failures, []
+        if failures:
+            raise RuntimeError(
+                "Failed to publish "
+                + ", ".join(f"{name} ({error})" for name, error in failures)
+            )
+
+
+_default_publisher = None
+_default_publisher_lock = threading.Lock()
+
+
+def get_artifact_publisher():
+    """
+    :return: the ArtifactPublisher shared by the process
+    """
+    global _default_publisher
+    with _default_publisher_lock:
+        if _default_publisher is None:
+            _default_publisher = ArtifactPublisher()
+        return _default_publisher
@@ -0,0 +1,117 @@
+"""
+Benchmark of CatBoost training on CPU with the cpu_profile of train.py.
+
+Fits a Quantile model with the parameters of train_final_models on --rows
+synthetic listings and logs the wall time and peak RSS every --log-every
+iterations, then extrapolates the wall time of --target-iterations to plan
+retrains on machines without a GPU.
+
+    python benchmarks/bench_cpu_training.py --rows 200000 --iterations 300
+    python benchmarks/bench_cpu_training.py --threads 4 --border-count 254
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+
+import pandas as pd
+from catboost import CatBoostRegressor, Pool
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_outliers import make_listings
+from train import cpu_profile
+
+
+class IterationLog:
+    """
+    CatBoost callback recording the wall time and peak RSS after every
+    iteration.
+    """
+
+    def __init__(self, log_every):
+        self.log_every = log_every
+        self.rows = []
+        self.start = time.perf_counter()
+
+    def after_iteration(self, info):
+        elapsed = time.perf_counter() - self.start
+        # ru_maxrss is in kB on Linux
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+        self.rows.append(
+            {"iteration": info.iteration, "seconds": elapsed, "peak_rss_mb": peak_mb}
+        )
+        if info.iteration % self.log_every == 0:
+            print(
+                f"  iteration {info.iteration}: {elapsed:.1f} s, "
+                f"peak RSS {peak_mb:.0f} MB"
+            )
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--iterations", type=int, default=300)
+    parser.add_argument("--target-iterations", type=int, default=11333)
+    parser.add_argument("--threads", type=int, help="every core if not set")
+    parser.add_argument("--border-count", type=int, help="the profile's if not set")
+    parser.add_argument("--depth", type=int, default=9)
+    parser.add_argument("--log-every", type=int, default=50)
+    parser.add_argument("--output", default="data/reports/bench_cpu_training.json")
+    args = parser.parse_args()
+
+    listings = make_listings(args.rows).dropna(subset=["raw_price"])
+    X = listings.drop(columns="raw_price")
+    X[["brand", "model"]] = X[["brand", "model"]].fillna("nan")
+    pool = Pool(X, listings.raw_price, cat_features=["brand", "model"])
+
+    profile = cpu_profile(args.threads)
+    if args.border_count is not None:
+        profile["border_count"] = args.border_count
+    print(f"CPU profile: {profile}")
+    model = CatBoostRegressor(
+        **profile,
+        iterations=args.iterations,
+        depth=args.depth,
+        grow_policy="Depthwise",
+        min_data_in_leaf=92,
+        learning_rate=0.027,
+        nan_mode="Max",
+        loss_function="Quantile:alpha=0.5",
+    )
+    log = IterationLog(args.log_every)
+    rss_before_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+    model.fit(pool, callbacks=[log], verbose=False)
+
+    iterations = pd.DataFrame(log.rows)
+    # The first iterations include the quantization of the pool
+    steady = iterations.seconds.diff().iloc[len(iterations) // 10 :]
+    summary = {
+        "rows": len(listings),
+        **profile,
+        "iterations": len(iterations),
+        "seconds": iterations.seconds.iloc[-1],
+        "seconds_per_iteration": steady.median(),
+        "peak_rss_mb": iterations.peak_rss_mb.iloc[-1],
+        "rss_before_fit_mb": rss_before_mb,
+        "target_iterations": args.target_iterations,
+        "target_minutes": steady.median() * args.target_iterations / 60,
+    }
+    for key, value in summary.items():
+        print(f"{key}: {round(value, 3) if isinstance(value, float) else value}")
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(
+            {"summary": summary, "iterations": iterations.to_dict(orient="records")},
+            f,
+            indent=4,
+        )
+
+
+if __name__ == "__main__":
+    main()
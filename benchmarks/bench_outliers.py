@@ -0,0 +1,235 @@
+"""
+Benchmark of the outlier detection of train.py on synthetic listings.
+
+Times the vectorized detect_outlier_on_groups and the single pass
+remove_outliers on --rows listings, and the former row-wise implementations on
+the first --legacy-rows of them (row-wise apply is too slow to run on a million
+rows), checking both give the same result. Peak memory is traced for
+remove_outliers.
+
+    python benchmarks/bench_outliers.py --rows 1000000 --legacy-rows 50000
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from train import remove_outliers
+
+
+def make_listings(n_rows, seed=0):
+    """
+    :return: listings with a few hundred brand/model pairs over 25 years, a log
+    price with heavy tails and some missing prices and group keys
+    """
+    rng = np.random.default_rng(seed)
+    brands = rng.integers(0, 60, n_rows)
+    models = brands * 10 + rng.integers(0, 10, n_rows)
+    years = rng.integers(2000, 2025, n_rows).astype(float)
+    raw_price = np.exp(
+        8 + brands / 30 + (years - 2000) / 20 + rng.standard_t(3, n_rows) / 3
+    )
+    listings = pd.DataFrame(
+        {
+            "brand": pd.Series(brands).map(lambda x: f"brand_{x}"),
+            "model": pd.Series(models).map(lambda x: f"model_{x}"),
+            "registration_year": years,
+            "raw_price": raw_price.round().clip(100),
+            "engine_size": rng.normal(1600, 400, n_rows),
+            "engine_power": rng.normal(120, 40, n_rows),
+        }
+    )
+    listings.loc[rng.random(n_rows) < 0.01, "raw_price"] = np.nan
+    listings.loc[rng.random(n_rows) < 0.01, "registration_year"] = np.nan
+    listings.loc[rng.random(n_rows) < 0.005, "model"] = np.nan
+    return listings
+
+
+def detect_outlier_on_groups(df, features, group_cols):
+    """
+    Flags the rows lying outside [Q1 - 1.5 * IQR, Q3 + 1.5 * IQR] of their group
+    for any of the features. Rows where the feature or a group key is missing
+    are not flagged on that feature.
+    :param df: dataframe, left untouched
+    :param features: numerical features to check
+    :param group_cols: columns defining the groups
+    :return: boolean series aligned on df, True for outliers
+    """
+    groups = df.groupby(group_cols, observed=True)[features]
+    Q1 = groups.transform("quantile", 0.25)
+    Q3 = groups.transform("quantile", 0.75)
+    IQR = Q3 - Q1
+    lower_bound = Q1 - 1.5 * IQR
+    upper_bound = Q3 + 1.5 * IQR
+    values = df[features]
+    is_outlier = (values < lower_bound) | (values > upper_bound)
+    return is_outlier.any(axis=1)
+
+
+def legacy_detect_outlier_on_groups(df, features, group_cols):
+    # Row-wise implementation train.py used before vectorization
+    Q1 = df.groupby(group_cols)[features].quantile(0.25)
+    Q3 = df.groupby(group_cols)[features].quantile(0.75)
+    IQR = Q3 - Q1
+    lower_bound = Q1 - 1.5 * IQR
+    upper_bound = Q3 + 1.5 * IQR
+    df = df.join(lower_bound, how="left", on=group_cols, rsuffix="_lower").copy()
+    df = df.join(upper_bound, how="left", on=group_cols, rsuffix="_upper").copy()
+
+    def detect_outlier(row, feature, lbound, ubound):
+        if pd.isna(row[feature]):
+            return False
+        else:
+            return row[feature] < lbound or row[feature] > ubound
+
+    is_outlier = pd.DataFrame(False, index=df.index, columns=features)
+    for feat in features:
+        is_outlier[feat] = df.apply(
+            lambda row: detect_outlier(
+                row, feat, row[f"{feat}_lower"], row[f"{feat}_upper"]
+            ),
+            axis=1,
+        )
+    df["is_outlier"] = is_outlier.any(axis=1)
+    return df
+
+
+def compute_lower_bound(series):
+    return series.quantile(0.25) - 1.5 * (series.quantile(0.75) - series.quantile(0.25))
+
+
+def legacy_remove_outliers(train):
+    # Three level implementation train.py used before the single pass version
+    train["raw_price_log"] = train.raw_price.apply(np.log)
+    features_IQR = ["raw_price_log"]
+    train["level_1"] = (
+        train.groupby(by=["brand", "model", "registration_year"]).transform("count")[
+            "raw_price"
+        ]
+        > 40
+    )
+    train["level_2"] = (
+        train.groupby(by=["brand", "model"]).transform("count")["raw_price"] > 40
+    )
+    train["level_3"] = train.groupby(by=["brand"]).transform("count")["raw_price"] > 40
+
+    train["is_outlier"] = False
+    train[train.level_1] = legacy_detect_outlier_on_groups(
+        train[train.level_1], features_IQR, ["brand", "model", "registration_year"]
+    )
+    train[train.level_2 & ~(train.level_1)] = legacy_detect_outlier_on_groups(
+        train[train.level_2 & ~(train.level_1)], features_IQR, ["brand", "model"]
+    )
+    train[~(train.level_1 | train.level_2) & (train.level_3)] = (
+        legacy_detect_outlier_on_groups(
+            train[~(train.level_1 | train.level_2) & (train.level_3)],
+            features_IQR,
+            ["brand"],
+        )
+    )
+
+    engine_size_lower = compute_lower_bound(train["engine_size"])
+    engine_power_lower = np.exp(
+        compute_lower_bound(train["engine_power"].apply(lambda x: np.log(x + 1e-10)))
+    )
+
+    train["is_engine_outlier"] = (train.engine_power < engine_power_lower) | (
+        train.engine_size < engine_size_lower
+    )
+    train["is_outlier_final"] = train.is_outlier | train.is_engine_outlier
+    train = train[~train.is_outlier_final].copy()
+    train.drop(
+        columns=[
+            "raw_price_log",
+            "level_1",
+            "level_2",
+            "level_3",
+            "is_engine_outlier",
+            "is_outlier",
+            "is_outlier_final",
+        ],
+        inplace=True,
+    )
+    return train
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def traced(function, *args):
+    tracemalloc.start()
+    result, elapsed = timed(function, *args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--legacy-rows", type=int, default=50_000)
+    args = parser.parse_args()
+
+    listings = make_listings(args.rows)
+    sample = listings.iloc[: args.legacy_rows].copy()
+    identical = True
+
+    print("detect_outlier_on_groups")
+    with np.errstate(divide="ignore"):
+        listings["raw_price_log"] = np.log(listings.raw_price)
+        sample["raw_price_log"] = np.log(sample.raw_price)
+    features = ["raw_price_log"]
+    group_cols = ["brand", "model", "registration_year"]
+
+    flags, vectorized_s = timed(
+        detect_outlier_on_groups, listings, features, group_cols
+    )
+    print(f"  vectorized on {args.rows} rows: {vectorized_s:.2f} s")
+    legacy_flags, legacy_s = timed(
+        legacy_detect_outlier_on_groups, sample, features, group_cols
+    )
+    sample_flags, sample_s = timed(
+        detect_outlier_on_groups, sample, features, group_cols
+    )
+    print(
+        f"  on {args.legacy_rows} rows: row-wise {legacy_s:.2f} s, "
+        f"vectorized {sample_s:.3f} s, speedup {legacy_s / sample_s:.0f}x, "
+        f"row-wise extrapolated to {args.rows} rows: "
+        f"{legacy_s * args.rows / args.legacy_rows:.0f} s"
+    )
+    identical &= legacy_flags["is_outlier"].equals(sample_flags)
+
+    print("remove_outliers")
+    listings = listings.drop(columns="raw_price_log")
+    sample = sample.drop(columns="raw_price_log")
+    kept, single_pass_s, single_pass_mb = traced(remove_outliers, listings)
+    print(
+        f"  single pass on {args.rows} rows: {single_pass_s:.2f} s, "
+        f"peak {single_pass_mb:.0f} MB, {len(listings) - len(kept)} rows removed"
+    )
+    legacy_kept, legacy_s, legacy_mb = traced(legacy_remove_outliers, sample.copy())
+    sample_kept, sample_s, sample_mb = traced(remove_outliers, sample)
+    print(
+        f"  on {args.legacy_rows} rows: three levels {legacy_s:.2f} s "
+        f"peak {legacy_mb:.0f} MB, single pass {sample_s:.3f} s "
+        f"peak {sample_mb:.0f} MB"
+    )
+    identical &= legacy_kept.equals(sample_kept)
+
+    if not identical:
+        sys.exit("Results differ from the row-wise implementation")
+    print("Results identical to the row-wise implementation")
+
+
+if __name__ == "__main__":
+    main()
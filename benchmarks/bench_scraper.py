@@ -0,0 +1,142 @@
+"""
+Offline benchmark of the scraper against the local MockCarApi.
+
+For every concurrency level, crawls the listing pages then scrapes the ad
+details in a fresh temporary directory and reports throughput and memory.
+
+    python benchmarks/bench_scraper.py --concurrency 1 4 16 --latency 0.05 0.2
+    python benchmarks/bench_scraper.py --journal data/crawl/rows.jsonl --store data/ads.sqlite
+
+With --min-speedup the script exits with an error when the highest concurrency
+isn't at least that many times faster than the lowest, to catch regressions.
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scrape
+from mock_api import (
+    MockCarApi,
+    load_recorded_ads,
+    load_recorded_pages,
+    synthetic_ads,
+    synthetic_pages,
+)
+
+
+def run_stage(function, *args, **kwargs):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def bench_concurrency(api, concurrency, requests_per_second, ids):
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            os.makedirs("data")
+            pd.DataFrame({"id": ids}).to_csv("data/processed_ads_df.csv")
+            requests_before = api.requests
+
+            output, pages_s, pages_peak = run_stage(
+                scrape.scraping_car_ads,
+                max_in_flight=concurrency,
+                requests_per_second=requests_per_second,
+            )
+            failed, ads_s, ads_peak = run_stage(
+                scrape.scrape_ads_one_by_one,
+                concurrency=concurrency,
+                requests_per_second=requests_per_second,
+            )
+        finally:
+            os.chdir(workdir)
+    return {
+        "concurrency": concurrency,
+        "pages": len(api.pages),
+        "pages_complete": output is not None,
+        "pages_per_s": round(len(api.pages) / pages_s, 2),
+        "pages_peak_mb": round(pages_peak / 1e6, 2),
+        "ads": len(ids),
+        "ads_failed": len(failed),
+        "ads_per_s": round(len(ids) / ads_s, 2),
+        "ads_peak_mb": round(ads_peak / 1e6, 2),
+        "server_requests": api.requests - requests_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--rows-per-page", type=int, default=30)
+    parser.add_argument("--ads", type=int, default=1000)
+    parser.add_argument("--journal", help="rows.jsonl of a crawl to replay")
+    parser.add_argument("--store", help="AdStore whose ads are replayed")
+    parser.add_argument("--latency", type=float, nargs=2, default=[0.02, 0.1])
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--requests-per-second", type=float, default=1000.0)
+    parser.add_argument("--min-speedup", type=float)
+    parser.add_argument("--output", default="data/reports/bench_scraper.json")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.journal:
+        pages = load_recorded_pages(args.journal, args.rows_per_page)[: args.pages]
+    else:
+        pages = synthetic_pages(args.pages, args.rows_per_page)
+    if args.store:
+        ads = load_recorded_ads(args.store, args.ads)
+    else:
+        ads = synthetic_ads(range(args.ads))
+
+    api = MockCarApi(
+        pages,
+        ads,
+        latency=tuple(args.latency),
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+    )
+    scrape.SCRAPING_URL = api.scraping_url
+    scrape.AD_URL = api.ad_url
+    scrape.PROXIES = {}
+
+    results = []
+    with api:
+        for concurrency in args.concurrency:
+            results.append(
+                bench_concurrency(api, concurrency, args.requests_per_second, list(ads))
+            )
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    print(f"Max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3:.0f} MB")
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results.to_dict(orient="records"), f, indent=4)
+
+    if args.min_speedup is not None:
+        speedup = results.ads_per_s.iloc[-1] / results.ads_per_s.iloc[0]
+        print(f"Ad throughput speedup: {speedup:.1f}x")
+        if speedup < args.min_speedup:
+            sys.exit(f"Speedup {speedup:.1f}x below {args.min_speedup}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import json
+import os
+
+import pandas as pd
+
+from listing_sink import (
+    JsonlListingSink,
+    ParquetListingSink,
+    infer_listing_schema,
+    read_jsonl,
+)
+
+EXPORT_CHUNK_SIZE = 10000
+
+
+class CrawlJournal:
+    """
+    Append-only record of a listing crawl. The rows of every completed page are
+    appended to rows.jsonl and cursor.json holds the next page to fetch with the
+    size rows.jsonl had once that page was written. A restarted crawl truncates
+    rows.jsonl back to that size and carries on from the cursor, so a page
+    interrupted half way is fetched again but never written twice. Listings
+    are deduplicated on their id across pages.
+    """
+
+    def __init__(self, directory="data/crawl", start_page=1):
+        os.makedirs(directory, exist_ok=True)
+        self.rows_path = os.path.join(directory, "rows.jsonl")
+        self.cursor_path = os.path.join(directory, "cursor.json")
+
+        cursor = {"next_page": start_page, "offset": 0, "finished": False}
+        if os.path.exists(self.cursor_path):
+            with open(self.cursor_path, "r") as f:
+                cursor = json.load(f)
+        self.next_page = cursor["next_page"]
+        self.finished = cursor["finished"]
+
+        self._sink = JsonlListingSink(self.rows_path, offset=cursor["offset"])
+
+    def commit_page(self, i, rows, is_last_page):
+        """
+        :param i: page number, pages have to be committed in order
+        :param rows: listing rows of the page
+        :param is_last_page: whether the crawl ends with this page
+        :return: the number of new listings found on the page
+        """
+        if i != self.next_page:
+            raise ValueError(f"Expected page {self.next_page}, got page {i}")
+        written = self._sink.write(rows)
+        offset = self._sink.sync()
+
+        self.next_page = i + 1
+        self.finished = is_last_page
+        self._write_cursor(offset)
+        return written
+
+    def _write_cursor(self, offset):
+        cursor = {
+            "next_page": self.next_page,
+            "offset": offset,
+            "finished": self.finished,
+        }
+        tmp_path = f"{self.cursor_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cursor, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.cursor_path)
+
+    def iter_rows(self):
+        return read_jsonl(self.rows_path)
+
+    def export(self, path):
+        """
+        Writes the crawled listings to path, as parquet or csv depending on its
+        extension, without loading the journal in memory.
+        """
+        if path.endswith(".parquet"):
+            self.export_parquet(path)
+        else:
+            self.export_csv(path)
+
+    def export_parquet(self, path):
+        schema = infer_listing_schema(self.iter_rows())
+        with ParquetListingSink(path, schema) as sink:
+            sink.write(self.iter_rows())
+
+    def export_csv(self, path):
+        """
+        Writes the journal to a csv in chunks. Listing rows don't all carry the
+        same keys, so a first pass collects the columns before writing.
+        """
+        columns = {}
+        for row in self.iter_rows():
+            columns.update(dict.fromkeys(row))
+        columns = list(columns)
+
+        header = True
+        chunk = []
+        for row in self.iter_rows():
+            chunk.append(row)
+            if len(chunk) == EXPORT_CHUNK_SIZE:
+                self._write_csv_chunk(chunk, columns, path, header)
+                header = False
+                chunk = []
+        if chunk or header:
+            self._write_csv_chunk(chunk, columns, path, header)
+
+    @staticmethod
+    def _write_csv_chunk(chunk, columns, path, header):
+        pd.DataFrame(chunk, columns=columns).to_csv(
+            path, mode="w" if header else "a", header=header, index=False
+        )
+
+    def close(self):
+        self._sink.close()
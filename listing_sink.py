@@ -0,0 +1,175 @@
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+ROW_GROUP_SIZE = 50000
+
+
+def read_jsonl(path):
+    if not os.path.exists(path):
+        return
+    with open(path, "r") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+class ListingSink:
+    """
+    Base class of the listing writers. Rows are keyed by the listing id so an ad
+    showing up on several pages (promoted listings) is only written once.
+    """
+
+    def __init__(self):
+        self.seen_ids = set()
+
+    def write(self, rows):
+        """
+        :param rows: listing rows as returned by the listing pages
+        :return: the number of rows written once duplicates are skipped
+        """
+        written = 0
+        for row in rows:
+            listing_id = row.get("id")
+            if listing_id is not None:
+                if listing_id in self.seen_ids:
+                    continue
+                self.seen_ids.add(listing_id)
+            self._write_row(row)
+            written += 1
+        return written
+
+    def _write_row(self, row):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class JsonlListingSink(ListingSink):
+    """
+    Appends one json line per listing. Ids already in the file are loaded on
+    opening so a resumed crawl keeps deduplicating against earlier pages.
+    """
+
+    def __init__(self, path, offset=None):
+        """
+        :param path: jsonl file to append to
+        :param offset: size to truncate the file to before appending, drops rows
+        written after the last synced point
+        """
+        super().__init__()
+        self.path = path
+        self._file = open(path, "ab")
+        if offset is not None:
+            self._file.truncate(offset)
+        self.seen_ids = {
+            row["id"] for row in read_jsonl(path) if row.get("id") is not None
+        }
+
+    def _write_row(self, row):
+        self._file.write(json.dumps(row).encode() + b"\n")
+
+    def sync(self):
+        """
+        :return: the size of the file once everything written is on disk
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+
+def _value_kind(value):
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, str):
+        return "str"
+    return "nested"
+
+
+def infer_listing_schema(rows):
+    """
+    Listing fields mix types from one ad to another, so the parquet type of a
+    column is decided from every value it takes: booleans and numbers keep their
+    type, anything else (strings, mixed types, lists and dicts) is stored as a
+    string, nested values being json encoded.
+    :param rows: iterable over all the listing rows
+    :return: a pyarrow schema with one field per key found in the rows
+    """
+    kinds = {}
+    for row in rows:
+        for key, value in row.items():
+            column_kinds = kinds.setdefault(key, set())
+            if value is not None:
+                column_kinds.add(_value_kind(value))
+
+    fields = []
+    for key, column_kinds in kinds.items():
+        if column_kinds == {"bool"}:
+            arrow_type = pa.bool_()
+        elif column_kinds == {"int"}:
+            arrow_type = pa.int64()
+        elif column_kinds and column_kinds <= {"int", "float"}:
+            arrow_type = pa.float64()
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(key, arrow_type))
+    return pa.schema(fields)
+
+
+def _to_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+class ParquetListingSink(ListingSink):
+    """
+    Writes listings to a parquet file one row group at a time so that memory is
+    bounded by row_group_size. The file is written under a temporary name and
+    only moved to path once closed.
+    """
+
+    def __init__(self, path, schema, row_group_size=ROW_GROUP_SIZE):
+        super().__init__()
+        self.path = path
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self._tmp_path = f"{path}.tmp"
+        self._writer = pq.ParquetWriter(self._tmp_path, schema)
+        self._buffer = []
+
+    def _write_row(self, row):
+        self._buffer.append(row)
+        if len(self._buffer) == self.row_group_size:
+            self._flush_row_group()
+
+    def _flush_row_group(self):
+        columns = {}
+        for field in self.schema:
+            values = [row.get(field.name) for row in self._buffer]
+            if pa.types.is_string(field.type):
+                values = [_to_string(value) for value in values]
+            columns[field.name] = pa.array(values, type=field.type)
+        self._writer.write_table(pa.table(columns, schema=self.schema))
+        self._buffer = []
+
+    def close(self):
+        if self._buffer:
+            self._flush_row_group()
+        self._writer.close()
+        os.replace(self._tmp_path, self.path)
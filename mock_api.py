@@ -0,0 +1,175 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from ad_store import AdStore
+from listing_sink import read_jsonl
+
+
+def load_recorded_pages(rows_path, rows_per_page=30):
+    """
+    :param rows_path: rows.jsonl of a crawl journal
+    :return: the recorded listing rows split into pages
+    """
+    pages = [[]]
+    for row in read_jsonl(rows_path):
+        if len(pages[-1]) == rows_per_page:
+            pages.append([])
+        pages[-1].append(row)
+    return pages
+
+
+def load_recorded_ads(store_path, limit=None):
+    """
+    :return: a dict mapping ad ids to the ad details saved in an AdStore
+    """
+    store = AdStore(store_path)
+    ads = {}
+    for id, ad in store.iter_ads():
+        if limit is not None and len(ads) == limit:
+            break
+        ads[id] = ad
+    store.close()
+    return ads
+
+
+def synthetic_pages(n_pages, rows_per_page=30):
+    return [
+        [
+            {
+                "id": page * rows_per_page + k,
+                "created": "2024-03-02 10:00:00",
+                "modified": "2024-03-02 10:00:00",
+                "price": f"{random.randint(1, 60)} 000 €",
+                "mileage": f"{random.randint(0, 300)} 000 km",
+                "title": "Car model listing title",
+            }
+            for k in range(rows_per_page)
+        ]
+        for page in range(n_pages)
+    ]
+
+
+def synthetic_ads(ids, size=4000):
+    # Ad details weigh a few kB, mostly extras and specifications
+    return {
+        str(id): {"id": id, "description": "x" * size, "extras": [], "price": 1000}
+        for id in ids
+    }
+
+
+class MockCarApi:
+    """
+    Local stand-in for the listing and ad apis, replaying recorded or synthetic
+    payloads so the scraper can be exercised offline:
+    - GET /pages?page={i} returns listing page i (1-based) in the listing api format,
+    - GET /ads/{id} returns the details of ad id in the ad api format, 404 if unknown.
+    Every request sleeps for a latency drawn uniformly in latency, then fails with
+    a 503 with probability error_rate or a 429 carrying Retry-After with
+    probability throttle_rate.
+    """
+
+    def __init__(
+        self,
+        pages=None,
+        ads=None,
+        latency=(0.0, 0.0),
+        error_rate=0.0,
+        throttle_rate=0.0,
+        retry_after=1,
+        port=0,
+    ):
+        self.pages = pages or []
+        self.ads = {str(id): ad for id, ad in (ads or {}).items()}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def scraping_url(self):
+        return self.url + "/pages?page={}"
+
+    @property
+    def ad_url(self):
+        return self.url + "/ads/"
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                status, body, headers = api.respond(self.path)
+                body = json.dumps(body).encode() if body is not None else b""
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def respond(self, path):
+        """
+        :return: (status, json body, headers) answered to a GET on path
+        """
+        with self._lock:
+            self.requests += 1
+        time.sleep(random.uniform(*self.latency))
+        draw = random.random()
+        if draw < self.error_rate:
+            return 503, None, {}
+        if draw < self.error_rate + self.throttle_rate:
+            return 429, None, {"Retry-After": str(self.retry_after)}
+
+        url = urlparse(path)
+        if url.path == "/pages":
+            i = int(parse_qs(url.query)["page"][0])
+            if not 1 <= i <= len(self.pages):
+                return 404, None, {}
+            results = {
+                "rows": self.pages[i - 1],
+                "pagination": {"is_last_page": i == len(self.pages)},
+            }
+            return 200, {"data": {"results": results}}, {}
+        if url.path.startswith("/ads/"):
+            ad = self.ads.get(url.path[len("/ads/") :])
+            if ad is None:
+                return 404, None, {}
+            return 200, {"data": {"classified": ad}}, {}
+        return 404, None, {}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
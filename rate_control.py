@@ -0,0 +1,249 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+from scrape_metrics import ScrapeMetrics
+
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+RATE_PERIOD = 10.0
+
+
+def parse_retry_after(value):
+    """
+    :param value: Retry-After header, either a number of seconds or an http date
+    :return: the number of seconds to wait, None if the header is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateController:
+    """
+    Sends requests on behalf of the page crawler and the ad fetcher and decides
+    when to retry them. It combines:
+    - a token bucket per host capping the request rate,
+    - exponential backoff with jitter between attempts, honouring Retry-After,
+    - an adaptive concurrency limit, halved whenever the error rate over the
+      last window of requests goes above error_rate_threshold and raised back
+      one step per clean window. When the limit is already at its minimum the
+      breaker opens and every request waits for cooldown seconds.
+    Latencies, bytes, retries and waiting times are recorded in metrics.
+    It is thread safe, one instance is shared by all the workers of a crawl.
+    """
+
+    def __init__(
+        self,
+        requests_per_second,
+        max_concurrency,
+        max_retries=7,
+        burst=1,
+        base_delay=0.5,
+        max_delay=60.0,
+        error_rate_threshold=0.2,
+        window=50,
+        cooldown=30.0,
+        retry_statuses=RETRY_STATUSES,
+        metrics=None,
+    ):
+        self.rate = requests_per_second
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.error_rate_threshold = error_rate_threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.retry_statuses = retry_statuses
+        self.metrics = metrics if metrics is not None else ScrapeMetrics("requests")
+
+        self.concurrency = max_concurrency
+        self._in_flight = 0
+        self._open_until = 0.0
+        self._outcomes = deque(maxlen=window)
+        self._buckets = {}
+        self._condition = threading.Condition()
+
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self._recent = deque()
+        self._started = time.monotonic()
+
+    def get(self, session, url, stop=None, **kwargs):
+        """
+        :param session: requests session used to send the request
+        :param url: url to get
+        :param stop: threading.Event abandoning the request once set, no new
+        attempt is sent and the backoff is interrupted
+        :return: the last response received, None if every attempt raised or
+        the request was abandoned
+        """
+        req = None
+        for attempt in range(self.max_retries):
+            if stop is not None and stop.is_set():
+                return None
+            self._acquire_token(url)
+            retry_after = None
+            response = None
+            with self._slot():
+                start = time.monotonic()
+                try:
+                    response = session.get(url=url, **kwargs)
+                    size = len(response.content)
+                except Exception as e:
+                    logging.debug(f"Request to {url} failed: {e}")
+                latency = time.monotonic() - start
+
+            if response is None:
+                self.metrics.record_attempt(latency, "error", 0)
+            else:
+                req = response
+                self.metrics.record_attempt(latency, req.status_code, size)
+                if req.status_code not in self.retry_statuses:
+                    self._record(attempt, error=False)
+                    self.metrics.record_request(attempt + 1)
+                    return req
+                retry_after = parse_retry_after(req.headers.get("Retry-After"))
+                logging.debug(f"Got status {req.status_code} from {url}")
+            self._record(attempt, error=True)
+
+            if retry_after is not None:
+                self._pause_host(url, retry_after)
+            if attempt < self.max_retries - 1:
+                delay = self._backoff(attempt, retry_after)
+                self.metrics.record_wait("backoff", delay)
+                if stop is None:
+                    time.sleep(delay)
+                elif stop.wait(delay):
+                    return None
+
+        with self._condition:
+            self.failures += 1
+        self.metrics.record_request(self.max_retries)
+        return req
+
+    def _backoff(self, attempt, retry_after=None):
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        delay = random.uniform(delay / 2, delay)
+        if retry_after is not None:
+            delay = max(delay, min(self.max_delay, retry_after))
+        return delay
+
+    def _acquire_token(self, url):
+        host = urlparse(url).netloc
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                tokens, updated = self._buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                if tokens >= 1:
+                    self._buckets[host] = (tokens - 1, now)
+                    return
+                self._buckets[host] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            self.metrics.record_wait("rate_limit", wait)
+            time.sleep(wait)
+
+    def _pause_host(self, url, seconds):
+        # A negative token count delays every worker sending to this host
+        host = urlparse(url).netloc
+        with self._condition:
+            now = time.monotonic()
+            tokens = self._buckets.get(host, (self.burst, now))[0]
+            self._buckets[host] = (min(tokens, 1 - seconds * self.rate), now)
+
+    @contextmanager
+    def _slot(self):
+        start = time.monotonic()
+        with self._condition:
+            while True:
+                wait = self._open_until - time.monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)
+                elif self._in_flight >= self.concurrency:
+                    self._condition.wait()
+                else:
+                    break
+            self._in_flight += 1
+        self.metrics.record_wait("concurrency", time.monotonic() - start)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def _record(self, attempt, error):
+        with self._condition:
+            now = time.monotonic()
+            self.requests += 1
+            if attempt > 0:
+                self.retries += 1
+            self._recent.append(now)
+            while self._recent[0] < now - RATE_PERIOD:
+                self._recent.popleft()
+            self._outcomes.append(error)
+            if len(self._outcomes) == self.window:
+                error_rate = sum(self._outcomes) / self.window
+                if error_rate > self.error_rate_threshold:
+                    self._slow_down(now, error_rate)
+                    self._outcomes.clear()
+                elif error_rate == 0 and self.concurrency < self.max_concurrency:
+                    self.concurrency += 1
+                    self._outcomes.clear()
+                    self._condition.notify_all()
+        self.metrics.maybe_report(
+            requests_per_second=round(self.requests_per_second(), 3),
+            retry_rate=round(self.retry_rate(), 4),
+            concurrency=self.concurrency,
+        )
+
+    def _slow_down(self, now, error_rate):
+        if self.concurrency > 1:
+            self.concurrency = max(1, self.concurrency // 2)
+            logging.warning(
+                f"Error rate at {error_rate:.0%}, lowering concurrency to {self.concurrency}"
+            )
+        else:
+            self._open_until = now + self.cooldown
+            logging.warning(
+                f"Error rate at {error_rate:.0%}, pausing requests for {self.cooldown} s"
+            )
+
+    def requests_per_second(self):
+        """
+        :return: the number of requests sent per second over the last RATE_PERIOD seconds
+        """
+        with self._condition:
+            now = time.monotonic()
+            while self._recent and self._recent[0] < now - RATE_PERIOD:
+                self._recent.popleft()
+            elapsed = min(RATE_PERIOD, now - self._started)
+            return len(self._recent) / elapsed if elapsed > 0 else 0.0
+
+    def retry_rate(self):
+        return self.retries / self.requests if self.requests else 0.0
+
+    def summary(self):
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            "retry_rate": self.retry_rate(),
+            "requests_per_second": self.requests_per_second(),
+            "concurrency": self.concurrency,
+        }
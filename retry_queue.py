@@ -0,0 +1,99 @@
+import sqlite3
+import threading
+import time
+
+from ad_store import AD_STORE_PATH
+
+MAX_ATTEMPTS = 5
+
+
+class RetryQueue:
+    """
+    Persistent queue of the ads that failed to scrape, kept in the same SQLite
+    file as the AdStore. Every failure is committed as it happens with its
+    attempt count and last error, so nothing is lost if a run crashes. The next
+    run re-drives the pending ids and an id failing max_attempts runs in a row is
+    moved to the dead letters, which are no longer retried.
+    It is safe to share one queue between threads.
+    """
+
+    def __init__(self, path=AD_STORE_PATH, max_attempts=MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS failed_ads ("
+            "id TEXT PRIMARY KEY, attempts INTEGER NOT NULL, last_error TEXT, "
+            "last_attempt REAL NOT NULL, dead INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._conn.commit()
+
+    def record_failure(self, id, error):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO failed_ads (id, attempts, last_error, last_attempt, dead) "
+                "VALUES (?, 1, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET attempts = attempts + 1, "
+                "last_error = excluded.last_error, "
+                "last_attempt = excluded.last_attempt, "
+                "dead = attempts + 1 >= ?",
+                (
+                    str(id),
+                    error,
+                    time.time(),
+                    self.max_attempts <= 1,
+                    self.max_attempts,
+                ),
+            )
+            self._conn.commit()
+
+    def resolve(self, id):
+        with self._lock:
+            self._conn.execute("DELETE FROM failed_ads WHERE id = ?", (str(id),))
+            self._conn.commit()
+
+    def pending(self):
+        """
+        :return: the ids still to retry
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT id FROM failed_ads WHERE dead = 0")
+            return {row[0] for row in rows}
+
+    def dead_ids(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT id FROM failed_ads WHERE dead = 1")
+            return {row[0] for row in rows}
+
+    def dead_letters(self):
+        """
+        :return: a list of (id, attempts, last_error) for the ids given up on
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, attempts, last_error FROM failed_ads "
+                "WHERE dead = 1 ORDER BY id"
+            ).fetchall()
+
+    def revive(self, ids=None):
+        """
+        Puts dead letters back in the queue with a fresh attempt count.
+        :param ids: ids to revive, every dead letter if None
+        """
+        with self._lock:
+            if ids is None:
+                self._conn.execute(
+                    "UPDATE failed_ads SET dead = 0, attempts = 0 WHERE dead = 1"
+                )
+            else:
+                self._conn.executemany(
+                    "UPDATE failed_ads SET dead = 0, attempts = 0 WHERE id = ?",
+                    ((str(id),) for id in ids),
+                )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,20 +1,30 @@
+import asyncio
 import base64
-import glob
-import json
 import logging
 import os
+import threading
 import time
-import uuid
 from concurrent.futures import ThreadPoolExecutor
 
-import numpy as np
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from tqdm import tqdm
 
+from ad_store import AD_STORE_PATH, AdStore
+from crawl_journal import CrawlJournal
+from rate_control import RateController
+from retry_queue import RetryQueue
+from scrape_metrics import ScrapeMetrics
+
 load_dotenv()
 MAX_RETRIES = 7
+DEFAULT_MAX_IN_FLIGHT = 8
+DEFAULT_AD_CONCURRENCY = 10
+DEFAULT_AD_REQUESTS_PER_SECOND = 20.0
+# Same pace as the former 0.5 s pause between two pages
+DEFAULT_REQUESTS_PER_SECOND = 2.0
 PROXY_API = os.environ.get("SCRAPER_API")
 SCRAPING_URL = os.environ.get("SCRAPING_URL")
 AD_URL = os.environ.get("CAR_API_URL")
@@ -31,112 +41,365 @@ HEADERS = {"User-Agent": "Mozilla/5.0"}
 logging.basicConfig(level=logging.INFO, handlers=[logging.StreamHandler()])
 
 
-# Scraping function:
-def scraping_car_ads():
-    """
-    :return: a dictionary of car ads with uuid as key
-    """
-    is_last_page = False
-    i = 4780
-    car_ads = {}
-    with tqdm() as pbar:
-        while not is_last_page:
-            print(f"Crawling page {i}")
-            url = SCRAPING_URL.format(i)
-            for attempt in range(MAX_RETRIES):
-                logging.info(f"Attempt number {attempt} at requesting from the url")
-                try:
-                    req = requests.get(
-                        url=url,
-                        headers=HEADERS,
-                        proxies=PROXIES,
-                        verify=False,
-                        timeout=10,
-                    )
-                    if req.status_code == 200:
-                        break
+def make_session(pool_size):
+    """
+    :param pool_size: number of connections kept open per host
+    :return: a session whose connection pool is shared by all the workers
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(HEADERS)
+    session.proxies.update(PROXIES)
+    session.verify = False
+    return session
 
-                except Exception as e:
-                    logging.error(e)
-                    logging.info(
-                        f"Encountered a problem while crawling page {i}. Saving pages {1} to {i-1}"
-                    )
-                time.sleep(1)
-
-            if req.status_code != 200:
-                backup_df = pd.DataFrame.from_dict(car_ads, orient="index")
-                backup_df.to_csv(f"data/car_ads_backup_{i}_v4.csv")
-                return backup_df
-
-            is_last_page = req.json()["data"]["results"]["pagination"]["is_last_page"]
-            c = 0
-            for car in req.json()["data"]["results"]["rows"]:
-                uuid_car = uuid.uuid4()
-                car_ads[uuid_car] = car
-                c += 1
-            print(f"Crawled {c} cars out of page{i}")
+
+def fetch_page(session, controller, i, stop=None):
+    """
+    :param i: number of the listing page to fetch
+    :param stop: threading.Event set once the crawl no longer needs the page
+    :return: the json payload of the page or None if every attempt failed. The
+    failure is only logged at debug level, pages past the last one are fetched
+    ahead and fail, crawl_pages reports the pages it needed.
+    """
+    url = SCRAPING_URL.format(i)
+    req = controller.get(session, url, stop=stop, timeout=10)
+    if stop is not None and stop.is_set():
+        return None
+    if req is None or req.status_code != 200:
+        status = None if req is None else req.status_code
+        logging.debug(f"Couldn't fetch page {i}: status {status}")
+        return None
+    try:
+        return req.json()
+    except ValueError as e:
+        logging.debug(f"Couldn't fetch page {i}: invalid json: {e!r}")
+        return None
+
+
+async def crawl_pages(start_page, max_in_flight, controller, on_page):
+    """
+    Crawls listing pages from start_page onwards keeping up to max_in_flight
+    requests open. Pages are handed to on_page(i, rows, is_last_page) strictly
+    in page order so the output is the same as crawling them one by one.
+    :return: the number of the page that failed, or None once the last page is reached
+    """
+    loop = asyncio.get_running_loop()
+    session = make_session(max_in_flight)
+    executor = ThreadPoolExecutor(max_workers=max_in_flight)
+    # Set on return so the fetches of pages past the last one stop retrying
+    stop = threading.Event()
+    pending = {}
+    next_to_schedule = start_page
+    i = start_page
+    try:
+        while True:
+            while len(pending) < max_in_flight:
+                pending[next_to_schedule] = loop.run_in_executor(
+                    executor, fetch_page, session, controller, next_to_schedule, stop
+                )
+                next_to_schedule += 1
+
+            page = await pending.pop(i)
+            if page is None:
+                logging.error(f"Couldn't fetch page {i}")
+                return i
+
+            is_last_page = page["data"]["results"]["pagination"]["is_last_page"]
+            on_page(i, page["data"]["results"]["rows"], is_last_page)
+            if is_last_page:
+                return None
             i += 1
-            pbar.update(1)
-            time.sleep(0.5)
-        logging.info(f"Finished crawling all pages \n Saving car ads to dataframe")
-        car_ads_df = pd.DataFrame.from_dict(car_ads, orient="index")
-        car_ads_df.to_csv("data/car_ads.csv")
+    finally:
+        stop.set()
+        for future in pending.values():
+            future.cancel()
+        executor.shutdown(wait=True, cancel_futures=True)
+        session.close()
 
-    return car_ads_df
 
+# Scraping function:
+def scraping_car_ads(
+    journal_dir="data/crawl",
+    output_path="data/car_ads.parquet",
+    start_page=1,
+    max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+    requests_per_second=DEFAULT_REQUESTS_PER_SECOND,
+    controller=None,
+):
+    """
+    Crawls the listing pages into a journal. Rerunning after a failure resumes
+    from the last page that was completely written.
+    :param journal_dir: directory holding the crawl journal and its cursor
+    :param output_path: parquet or csv file the deduplicated listings are written to
+    :param start_page: first listing page to crawl when the journal is new
+    :param max_in_flight: number of page requests kept open at once, 1 crawls sequentially
+    :param requests_per_second: maximum request rate sent to the listing host
+    :param controller: RateController to share with other fetchers, built from
+    max_in_flight and requests_per_second if None
+    :return: output_path once every page is crawled, None if the crawl is unfinished
+    """
+    if controller is None:
+        controller = RateController(
+            requests_per_second,
+            max_in_flight,
+            MAX_RETRIES,
+            metrics=ScrapeMetrics("pages"),
+        )
+    journal = CrawlJournal(journal_dir, start_page)
+    try:
+        if not journal.finished:
+            print(f"Crawling from page {journal.next_page}")
+            with tqdm() as pbar:
+
+                def on_page(i, rows, is_last_page):
+                    new_cars = journal.commit_page(i, rows, is_last_page)
+                    logging.debug(f"Crawled {new_cars} new cars out of page{i}")
+                    controller.metrics.record_items()
+                    pbar.update(1)
+
+                failed_page = asyncio.run(
+                    crawl_pages(journal.next_page, max_in_flight, controller, on_page)
+                )
+
+            if failed_page is not None:
+                logging.info(
+                    f"Encountered a problem while crawling page {failed_page}. "
+                    f"Rerun to resume the crawl from this page"
+                )
+                return None
+
+        logging.info(f"Finished crawling all pages \n Saving car ads to {output_path}")
+        journal.export(output_path)
+    finally:
+        journal.close()
+        controller.metrics.write_report(controller=controller.summary())
+
+    return output_path
 
-def ad_request(id):
+
+def ad_request(id, session=None, controller=None, store=None, queue=None):
+    """
+    :param id: id of the ad to scrape
+    :param session: session to send the request through, a new one is opened if None
+    :param controller: RateController pacing and retrying the request
+    :param store: AdStore the ad is saved to, the default store is opened if None
+    :param queue: RetryQueue recording the failure, or clearing the id on success
+    :return: None if the ad was saved, its id otherwise
+    """
+    if store is None:
+        store = AdStore()
+    if session is None:
+        session = make_session(1)
+    if controller is None:
+        controller = RateController(DEFAULT_AD_REQUESTS_PER_SECOND, 1, MAX_RETRIES)
     url = AD_URL + str(id)
-    req = None
-    for attempt in range(MAX_RETRIES):
-        logging.info(f"Attempt number {attempt} at requesting from the url")
-        try:
-            req = requests.get(
-                url=url, headers=HEADERS, proxies=PROXIES, verify=False, timeout=10
-            )
-            if req.status_code == 200:
-                break
+    req = controller.get(session, url, timeout=10)
 
+    error = None
+    if req is None:
+        error = "no response"
+    elif req.status_code != 200:
+        error = f"status {req.status_code}"
+    else:
+        try:
+            response = req.json()["data"]["classified"]
         except Exception as e:
-            logging.error(e)
-            logging.info(f"Encountered a problem while crawling ad number {id}")
+            error = f"invalid json: {e!r}"
 
-    if req.status_code != 200:
+    if error is not None:
+        logging.error(f"Encountered a problem while crawling ad number {id}: {error}")
+        if queue is not None:
+            queue.record_failure(id, error)
         return id
+
+    store.put(id, response)
+    if queue is not None:
+        queue.resolve(id)
+    return None
+
+
+async def fetch_ads(ids, concurrency, controller, store, queue=None):
+    """
+    Scrapes the ads with up to concurrency requests in flight, all of them going
+    through one session so that connections to the proxy are kept alive and
+    reused instead of opening a new TLS connection per ad.
+    :return: the ids of the ads that couldn't be scraped
+    """
+    loop = asyncio.get_running_loop()
+    session = make_session(concurrency)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    pending = set()
+    failed_ads = []
+    try:
+        with tqdm(total=len(ids)) as pbar:
+            ids = iter(ids)
+            while True:
+                for id in ids:
+                    pending.add(
+                        loop.run_in_executor(
+                            executor, ad_request, id, session, controller, store, queue
+                        )
+                    )
+                    if len(pending) == 2 * concurrency:
+                        break
+                if not pending:
+                    break
+
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    if future.result() is not None:
+                        failed_ads.append(future.result())
+                    else:
+                        controller.metrics.record_items()
+                pbar.update(len(done))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        session.close()
+    return failed_ads
+
+
+def scrape_ads_one_by_one(
+    concurrency=DEFAULT_AD_CONCURRENCY,
+    requests_per_second=DEFAULT_AD_REQUESTS_PER_SECOND,
+    controller=None,
+    store_path=AD_STORE_PATH,
+    ids_path="data/processed_ads_df.csv",
+):
+    """
+    :param concurrency: number of ad requests sent at once
+    :param requests_per_second: maximum request rate sent to the ad host
+    :param controller: RateController to share with other fetchers, built from
+    concurrency and requests_per_second if None
+    :param store_path: path of the AdStore the ads are saved to, failed ads are
+    queued in the same file and retried first on the next run
+    :param ids_path: csv with the ids of the ads to scrape
+    :return: the ids of the ads that couldn't be scraped
+    """
+    ids = pd.read_csv(ids_path, usecols=["id"])["id"].astype("str").tolist()
+    store = AdStore(store_path)
+    queue = RetryQueue(store_path)
+    try:
+        pending = queue.pending()
+        ids_to_scrape = list(pending) + list(
+            set(ids) - store.ids() - pending - queue.dead_ids()
+        )
+        print(f"Retrying {len(pending)} failed ads, {len(ids_to_scrape)} ads to scrape")
+        if controller is None:
+            controller = RateController(
+                requests_per_second,
+                concurrency,
+                MAX_RETRIES,
+                metrics=ScrapeMetrics("ads"),
+            )
+        failed_ads = asyncio.run(
+            fetch_ads(ids_to_scrape, concurrency, controller, store, queue)
+        )
+    finally:
+        store.close()
+        queue.close()
+    controller.metrics.write_report(controller=controller.summary())
+    return failed_ads
+
+
+def read_listing_versions(listings_path):
+    """
+    :param listings_path: parquet or csv file written by scraping_car_ads
+    :return: a dataframe with the id, created and modified fields of every listing as strings
+    """
+    columns = ["id", "created", "modified"]
+    if listings_path.endswith(".parquet"):
+        listings = pd.read_parquet(listings_path, columns=columns)
     else:
-        try:
-            response = req.json()["data"]["classified"]
-        except:
-            print(f"Couldn't access json of ad {id}")
-            return id
-        with open(f"data/ads/{id}.json", "w") as file:
-            json.dump(response, file, indent=4, sort_keys=True)
-        return None
+        listings = pd.read_csv(listings_path, usecols=columns)
+    listings = listings.astype("string").astype(object)
+    return listings.where(listings.notna(), None).drop_duplicates(subset="id")
 
 
-def scrape_ads_one_by_one():
-    ids = (
-        pd.read_csv("data/processed_ads_df.csv", usecols=["id"])["id"]
-        .astype("str")
-        .tolist()
-    )
-    scraped_ads = [
-        os.path.splitext(os.path.basename(x))[0] for x in glob.glob("data/ads/*.json")
-    ]
-    ids_to_scrape = list(set(ids) - set(scraped_ads))
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        results = list(executor.map(ad_request, ids_to_scrape))
-
-    failed_ads = [ads for ads in results if ads is not None]
-
-    if failed_ads:
-        np.save(
-            arr=np.array(failed_ads), file="data/ads/failed_ads_crawl/failed_ads.npy"
+def scrape_ads_incremental(
+    listings_path,
+    concurrency=DEFAULT_AD_CONCURRENCY,
+    requests_per_second=DEFAULT_AD_REQUESTS_PER_SECOND,
+    controller=None,
+    store_path=AD_STORE_PATH,
+):
+    """
+    Only scrapes the ads that are new or whose modified date changed since the
+    last crawl, then marks the listings that vanished from the crawl as delisted.
+    Ads that fail keep their previous version and go to the retry queue so they
+    are fetched again next run.
+    :param listings_path: listings of the current crawl, as written by scraping_car_ads
+    :return: the ids of the ads that couldn't be scraped
+    """
+    listings = read_listing_versions(listings_path)
+    store = AdStore(store_path)
+    queue = RetryQueue(store_path)
+    try:
+        versions = store.listing_versions()
+        scraped_ads = store.ids()
+        pending = queue.pending()
+        dead_ids = queue.dead_ids()
+        ids_to_scrape = [
+            id
+            for id, modified in zip(listings["id"], listings["modified"])
+            if id not in pending
+            and id not in dead_ids
+            and (
+                id not in scraped_ads or id not in versions or versions[id] != modified
+            )
+        ]
+        print(
+            f"{len(ids_to_scrape)} new or modified ads out of {len(listings)}, "
+            f"retrying {len(pending)} failed ads"
+        )
+        ids_to_scrape = list(pending) + ids_to_scrape
+
+        if controller is None:
+            controller = RateController(
+                requests_per_second,
+                concurrency,
+                MAX_RETRIES,
+                metrics=ScrapeMetrics("ads"),
+            )
+        failed_ads = asyncio.run(
+            fetch_ads(ids_to_scrape, concurrency, controller, store, queue)
         )
+        controller.metrics.write_report(controller=controller.summary())
 
+        # Ads not fetched in this run, failed or given up on, keep their last
+        # recorded version so they are fetched again once revived or retried
+        not_fetched = set(failed_ads) | queue.pending() | queue.dead_ids()
+        store.record_listings(
+            row
+            for row in listings.itertuples(index=False, name=None)
+            if row[0] not in not_fetched
+        )
+        delisted = store.mark_delisted(listings["id"])
+        print(f"{delisted} ads were delisted since the last crawl")
+    finally:
+        store.close()
+        queue.close()
     return failed_ads
 
 
+def daily_crawl():
+    """
+    Crawls the listing pages into a journal of the day then refreshes the ads
+    that changed since the previous crawl.
+    """
+    day = time.strftime("%Y%m%d")
+    listings_path = scraping_car_ads(
+        journal_dir=f"data/crawl/{day}", output_path=f"data/car_ads_{day}.parquet"
+    )
+    if listings_path is None:
+        return None
+    return scrape_ads_incremental(listings_path)
+
+
 if __name__ == "__main__":
     unscraped_ads = scrape_ads_one_by_one()
 
@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, float("inf")]
+REPORT_INTERVAL = 30.0
+
+
+class ScrapeMetrics:
+    """
+    Throughput and latency counters of one scraping stage (listing pages or ad
+    details), updated by the RateController and the fetchers from any thread.
+    Worker times are summed over workers, so with 10 workers waiting on the
+    network for one second the network time grows by 10 seconds. A one line json summary is logged every
+    report_interval seconds and write_report saves the final one.
+    """
+
+    def __init__(self, stage, report_interval=REPORT_INTERVAL):
+        self.stage = stage
+        self.report_interval = report_interval
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._last_report = self._started
+
+        self.requests = 0
+        self.bytes = 0
+        self.items = 0
+        self.status_counts = Counter()
+        self.latency_counts = [0] * len(LATENCY_BUCKETS)
+        self.latency_total = 0.0
+        self.attempts_per_request = Counter()
+        self.time_s = Counter()
+
+    def record_attempt(self, latency, status, size):
+        """
+        :param latency: seconds spent waiting on the network for the attempt
+        :param status: http status, or "error" if the request raised
+        :param size: number of bytes downloaded
+        """
+        with self._lock:
+            self.requests += 1
+            self.bytes += size
+            self.status_counts[str(status)] += 1
+            self.latency_counts[bisect_left(LATENCY_BUCKETS, latency)] += 1
+            self.latency_total += latency
+            self.time_s["network"] += latency
+
+    def record_request(self, attempts):
+        """
+        :param attempts: number of attempts a request took, retries included
+        """
+        with self._lock:
+            self.attempts_per_request[attempts] += 1
+
+    def record_wait(self, kind, seconds):
+        """
+        :param kind: what the worker waited for: rate_limit, backoff or concurrency
+        """
+        with self._lock:
+            self.time_s[kind] += seconds
+
+    def record_items(self, count=1):
+        with self._lock:
+            self.items += count
+        self.maybe_report()
+
+    def _latency_quantile(self, q):
+        target = q * sum(self.latency_counts)
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.latency_counts):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return None
+
+    def summary(self, **extra):
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            requests = sum(self.attempts_per_request.values())
+            retries = sum((n - 1) * c for n, c in self.attempts_per_request.items())
+            summary = {
+                "stage": self.stage,
+                "elapsed_s": round(elapsed, 3),
+                "items": self.items,
+                "items_per_s": round(self.items / elapsed, 3) if elapsed else 0.0,
+                "attempts": self.requests,
+                "attempts_per_s": round(self.requests / elapsed, 3) if elapsed else 0.0,
+                "bytes": self.bytes,
+                "mb_per_s": round(self.bytes / 1e6 / elapsed, 3) if elapsed else 0.0,
+                "status_counts": dict(self.status_counts),
+                "retries_per_request": (
+                    round(retries / requests, 3) if requests else 0.0
+                ),
+                "attempts_histogram": {
+                    str(k): v for k, v in sorted(self.attempts_per_request.items())
+                },
+                "latency_s": {
+                    "mean": (
+                        round(self.latency_total / self.requests, 4)
+                        if self.requests
+                        else None
+                    ),
+                    "p50": self._latency_quantile(0.5),
+                    "p90": self._latency_quantile(0.9),
+                    "p99": self._latency_quantile(0.99),
+                    "histogram": {
+                        f"le_{bound}": count
+                        for bound, count in zip(LATENCY_BUCKETS, self.latency_counts)
+                    },
+                },
+                "worker_time_s": {k: round(v, 3) for k, v in self.time_s.items()},
+            }
+        summary.update(extra)
+        return summary
+
+    def maybe_report(self, **extra):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_report < self.report_interval:
+                return
+            self._last_report = now
+        logging.info(json.dumps(self.summary(**extra)))
+
+    def write_report(self, directory="data/reports", **extra):
+        """
+        :return: path of the json report of the stage
+        """
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(
+            directory, f"{self.stage}_{time.strftime('%Y%m%d_%H%M%S')}.json"
+        )
+        summary = self.summary(**extra)
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=4)
+        logging.info(json.dumps(summary))
+        return path
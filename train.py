@@ -1,101 +1,209 @@
+import hashlib
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import numpy as np
 import optuna
 import pandas as pd
 from catboost import CatBoostRegressor, Pool
-from google.cloud import storage
-from sklearn.metrics import mean_absolute_error, mean_absolute_percentage_error
+from optuna.study import MaxTrialsCallback
+from optuna.trial import TrialState
+from sklearn.metrics import mean_absolute_percentage_error
 from sklearn.model_selection import ShuffleSplit
 
+from artifact_cache import get_artifact_cache, get_artifact_publisher
 from const import low_importances
-
-
-def load_train_test():
-
+from preprocessing import (
+    PREPROCESSING_VERSION,
+    STRATEGIES,
+    PreprocessingPipeline,
+    fill_missing_categories,
+    normalize_types,
+    process_types,
+    read_dataset,
+    write_dataset,
+)
+from quantile_models import predict_quantiles, production_model_names
+
+TRAIN_SET = "train_02032024"
+TEST_SET = "test_02032024"
+PROCESSED_SETS_DIR = "processed_sets"
+# Borders of the quantized fold pools, the CatBoost default on GPU
+FOLD_BORDER_COUNT = 128
+STUDY_JOURNAL = "studies/optuna_journal.log"
+N_TRIALS = 30
+EARLY_STOPPING_ROUNDS = 50
+# Share of the machine memory CatBoost may use on CPU, see cpu_profile
+RAM_FRACTION = 0.8
+# Smoke runs with TRAIN_QUICK=1 fit few trees and stop early
+QUICK = os.environ.get("TRAIN_QUICK") == "1"
+QUICK_ITERATIONS = 200
+QUICK_EARLY_STOPPING_ROUNDS = 10
+QUANTILES = [0.25, 0.5, 0.75]
+# Share of the prices expected between the first and last quantiles
+NOMINAL_COVERAGE = QUANTILES[-1] - QUANTILES[0]
+MULTI_QUANTILE_LOSS = "MultiQuantile:alpha=" + ",".join(str(q) for q in QUANTILES)
+# MultiQuantile isn't implemented on GPU, the model trains with the cpu_profile
+MULTI_QUANTILE_TASK_TYPE = "CPU"
+# Listings added to the models by retrain_incremental since TRAIN_SET
+RETRAINED_SET = "retrained_listings"
+RETRAIN_ITERATIONS = 500
+# Relative increase of the held-out pinball loss a refresh may cause
+RETRAIN_TOLERANCE = 0.0
+
+
+def convert_csv_set(name):
+    """
+    Converts the csv set name of the bucket to a typed Parquet set uploaded next
+    to it.
+    """
+    print(f"Converting {name}.csv to Parquet")
+    cache = get_artifact_cache()
+    csv_path = cache.get(f"data/train_test_sets/{name}.csv")
+    path = write_dataset(
+        normalize_types(pd.read_csv(csv_path, index_col=0)), f"{name}.parquet"
+    )
+    get_artifact_publisher().publish(f"data/train_test_sets/{path}", path).wait()
+
+
+def load_set(name, columns=None):
+    """
+    Loads the typed Parquet set name through the artifact cache, converting it
+    once from the csv set if the bucket doesn't have it yet.
+    :param columns: columns to read, every column if None
+    """
+    cache = get_artifact_cache()
+    blob_name = f"data/train_test_sets/{name}.parquet"
+    try:
+        path = cache.get(blob_name)
+    except FileNotFoundError:
+        convert_csv_set(name)
+        path = cache.get(blob_name)
+    return read_dataset(path, columns)
+
+
+def load_train_test(columns=None):
+    """
+    Loads the typed Parquet train and test sets through the artifact cache,
+    converting them once from the csv sets if the bucket doesn't have them yet.
+    :param columns: columns to read, every column if None
+    """
     print("Loading training data...")
 
-    client = storage.Client()
-    bucket = client.get_bucket("price-estimation")
-    blob_train = bucket.get_blob("data/train_test_sets/train_02032024.csv")
-    blob_test = bucket.get_blob("data/train_test_sets/test_02032024.csv")
-
-    train_name = "train_02032024.csv"
-    test_name = "test_02032024.csv"
-    blob_train.download_to_filename(train_name)
-    blob_test.download_to_filename(test_name)
-
-    train = pd.read_csv(train_name, index_col=0)
-    test = pd.read_csv(test_name, index_col=0)
+    cache = get_artifact_cache()
+    names = [f"data/train_test_sets/{x}.parquet" for x in [TRAIN_SET, TEST_SET]]
+    try:
+        paths = cache.get_many(names)
+    except FileNotFoundError:
+        for name, blob_name in zip([TRAIN_SET, TEST_SET], names):
+            if cache.version(blob_name) is None:
+                convert_csv_set(name)
+        paths = cache.get_many(names)
+    train = read_dataset(paths[names[0]], columns)
+    test = read_dataset(paths[names[1]], columns)
     return train, test
 
 
-def save_model(model, model_name):
+def save_model(model, model_name, pipeline=None):
+    """
+    Saves the model locally and queues its upload.
+    :param pipeline: PreprocessingPipeline of the model, saved next to it as
+    {model_name}_preprocessing.json
+    """
     path = f"{model_name}.cbm"
     model.save_model(path)
-    client = storage.Client()
-    bucket = client.get_bucket("price-estimation")
-    blob = bucket.blob(f"models/{model_name}.cbm")
-    blob.upload_from_filename(path)
+    publisher = get_artifact_publisher()
+    publisher.publish(f"models/{path}", path)
+    if pipeline is not None:
+        pipeline_path = pipeline.save(f"{model_name}_preprocessing.json")
+        publisher.publish(f"models/{pipeline_path}", pipeline_path)
     print(f"Model {model_name} saved")
 
 
-def save_results(df, results_name):
-    path = f"{results_name}.csv"
-    df.to_csv(path)
-    client = storage.Client()
-    bucket = client.get_bucket("price-estimation")
-    blob = bucket.blob(f"data/results/{results_name}")
-    blob.upload_from_filename(path)
-    print(f"Results {results_name} saved")
+def load_model(model_name):
+    """
+    :return: the published model model_name, from the artifact cache
+    """
+    path = get_artifact_cache().get(f"models/{model_name}.cbm")
+    return CatBoostRegressor().load_model(path)
 
 
-def save_processed_set(df, df_name):
-    path = f"{df_name}.csv"
-    df.to_csv(path)
-    client = storage.Client()
-    bucket = client.get_bucket("price-estimation")
-    blob = bucket.blob(f"data/train_test_sets/{df_name}")
-    blob.upload_from_filename(path)
-    print(f"Results {df_name} saved")
-
-
-def drop_unwanted_columns(train, test):
-    print(f"Dropping unwanted columns")
-    columns_to_drop = [
-        "uuid",
-        "label",
-        "model_stub",
-        "thumbs",
-        "price_debatable",
-        "user_id",
-        "title",
-        "without_vat",
-        "seller",
-        "created",
-        "seo_json_ld",
-        "address_long",
-        "modified",
-        "battery_range",
-        "variant",
-        "trim",
-        "id",
-        "descriptive_title",
-        "description",
-    ]
-    train = train.drop(columns=columns_to_drop).copy()
-    test = test.drop(columns=columns_to_drop).copy()
-    return train, test
+def load_pipeline(model_name):
+    """
+    :return: the PreprocessingPipeline published with the model model_name
+    """
+    path = get_artifact_cache().get(f"models/{model_name}_preprocessing.json")
+    return PreprocessingPipeline.load(path)
 
 
-def process_types(data_set):
-    data_set["fuel_consumption"] = (
-        data_set["fuel_consumption"].astype(str).str.replace(",", ".").astype(float)
-    )
-    data_set["battery_charge_time"] = data_set["battery_charge_time"].astype(float)
-    data_set["registration_year"] = data_set["registration_year"].astype(float)
-    data_set["acceleration"] = (
-        data_set["acceleration"].astype(str).str.replace(",", ".").astype(float)
-    )
-    return data_set
+def save_results(df, results_name):
+    """
+    Saves the results locally and queues their upload.
+    """
+    path = write_dataset(df, f"{results_name}.parquet")
+    get_artifact_publisher().publish(f"data/results/{path}", path)
+    print(f"Results {results_name} saved")
+
+
+def wait_for_uploads():
+    print("Waiting for the artifact uploads to finish")
+    publisher = get_artifact_publisher()
+    publisher.wait()
+    print(f"{len(publisher.uploaded)} artifacts uploaded")
+
+
+def data_hash(*dfs):
+    """
+    :return: a short hash of the content of the frames and of the preprocessing
+    version, identifying the processed sets built from them
+    """
+    digest = hashlib.sha1(str(PREPROCESSING_VERSION).encode())
+    for df in dfs:
+        digest.update(",".join(map(str, df.columns)).encode())
+        digest.update(pd.util.hash_pandas_object(df).to_numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def load_processed_sets(key, directory=PROCESSED_SETS_DIR):
+    """
+    Looks for the processed sets of key on disk, then in the artifact cache.
+    :return: (train, test, pipeline), or None if they were never saved
+    """
+    names = ["train.parquet", "test.parquet", "preprocessing.json"]
+    paths = [os.path.join(directory, key, name) for name in names]
+    if not all(os.path.exists(path) for path in paths):
+        try:
+            paths = get_artifact_cache().get_many(
+                [f"data/train_test_sets/processed/{key}/{name}" for name in names]
+            )
+        except FileNotFoundError:
+            return None
+        paths = list(paths.values())
+    print(f"Loading processed sets {key}")
+    train = read_dataset(paths[0])
+    test = read_dataset(paths[1])
+    return train, test, PreprocessingPipeline.load(paths[2])
+
+
+def save_processed_sets(key, train, test, pipeline, directory=PROCESSED_SETS_DIR):
+    os.makedirs(os.path.join(directory, key), exist_ok=True)
+    publisher = get_artifact_publisher()
+    for name, save in [
+        ("train.parquet", lambda path: write_dataset(train, path)),
+        ("test.parquet", lambda path: write_dataset(test, path)),
+        ("preprocessing.json", pipeline.save),
+    ]:
+        # Written under a temporary name so readers never see a partial file
+        path = os.path.join(directory, key, name)
+        tmp_path = f"{path}.{os.getpid()}"
+        save(tmp_path)
+        os.replace(tmp_path, path)
+        publisher.publish(
+            f"data/train_test_sets/processed/{key}/{name}", path, skip_existing=True
+        )
+    print(f"Processed sets {key} saved")
 
 
 def get_train_val_test_pools(train, test, strategy):
@@ -112,12 +220,8 @@ def get_train_val_test_pools(train, test, strategy):
         ).columns.tolist()
     ]
 
-    X_train.iloc[:, categorical_features] = X_train.iloc[
-        :, categorical_features
-    ].fillna("nan")
-    X_test.iloc[:, categorical_features] = X_test.iloc[:, categorical_features].fillna(
-        "nan"
-    )
+    X_train = fill_missing_categories(X_train, categorical_features)
+    X_test = fill_missing_categories(X_test, categorical_features)
     train_pool = Pool(data=X_train, label=y_train, cat_features=categorical_features)
     test_pool = Pool(data=X_test, label=y_test, cat_features=categorical_features)
 
@@ -127,261 +231,166 @@ def get_train_val_test_pools(train, test, strategy):
     return train_pool, test_pool, y_train, y_test
 
 
-def detect_outlier_on_groups(df, features, group_cols):
-    Q1 = df.groupby(group_cols)[features].quantile(0.25)
-    Q3 = df.groupby(group_cols)[features].quantile(0.75)
-    IQR = Q3 - Q1
-    lower_bound = Q1 - 1.5 * IQR
-    upper_bound = Q3 + 1.5 * IQR
-    df = df.join(lower_bound, how="left", on=group_cols, rsuffix="_lower").copy()
-    df = df.join(upper_bound, how="left", on=group_cols, rsuffix="_upper").copy()
-
-    def detect_outlier(row, feature, lbound, ubound):
-        if pd.isna(row[feature]):
-            return False
-        else:
-            return row[feature] < lbound or row[feature] > ubound
-
-    is_outlier = pd.DataFrame(False, index=df.index, columns=features)
-    for feat in features:
-        is_outlier[feat] = df.apply(
-            lambda row: detect_outlier(
-                row, feat, row[f"{feat}_lower"], row[f"{feat}_upper"]
-            ),
-            axis=1,
+def build_fold_pools(
+    train_processed, strategy, n_splits=3, border_count=FOLD_BORDER_COUNT
+):
+    """
+    Builds the cross validation pools once per strategy, so the trials of a
+    study only fit models. Each train fold pool is quantized once and its
+    borders, saved in PROCESSED_SETS_DIR/folds_{strategy}, quantize the
+    validation fold the same way.
+    :return: a list of (train_pool, val_pool, y_val) per fold
+    """
+    directory = os.path.join(PROCESSED_SETS_DIR, f"folds_{strategy}")
+    os.makedirs(directory, exist_ok=True)
+    kf = ShuffleSplit(n_splits=n_splits, test_size=0.2, random_state=42)
+    fold_pools = []
+    for fold, (train_index, val_index) in enumerate(kf.split(train_processed)):
+        print(f"Building pools of fold {fold}")
+        train_pool, val_pool, _, y_val = get_train_val_test_pools(
+            train_processed.iloc[train_index],
+            train_processed.iloc[val_index],
+            strategy,
         )
-    df["is_outlier"] = is_outlier.any(axis=1)
-    return df
+        train_pool.quantize(border_count=border_count, nan_mode="Max")
+        # Study workers build the same pools at once, each writes its own file
+        borders_path = os.path.join(directory, f"fold_{fold}_borders.tsv")
+        tmp_path = f"{borders_path}.{os.getpid()}"
+        train_pool.save_quantization_borders(tmp_path)
+        os.replace(tmp_path, borders_path)
+        val_pool.quantize(input_borders=borders_path)
+        fold_pools.append((train_pool, val_pool, y_val))
+    return fold_pools
 
 
 def compute_lower_bound(series):
     return series.quantile(0.25) - 1.5 * (series.quantile(0.75) - series.quantile(0.25))
 
 
-def remove_outliers(train):
-    train["raw_price_log"] = train.raw_price.apply(np.log)
-    features_IQR = ["raw_price_log"]
-    train["level_1"] = (
-        train.groupby(by=["brand", "model", "registration_year"]).transform("count")[
-            "raw_price"
+def group_quantiles(groups, values, n_groups, quantiles):
+    """
+    Quantiles of values within each group computed from a single sort, with the
+    linear interpolation pandas uses for groupby quantiles.
+    :param groups: group number of each value, -1 to leave the value out
+    :param values: float array, NaN values are left out
+    :param n_groups: number of groups
+    :param quantiles: list of quantiles to compute
+    :return: one array of n_groups values per quantile, NaN for empty groups
+    """
+    valid = (groups >= 0) & ~np.isnan(values)
+    groups, values = groups[valid], values[valid]
+    order = np.lexsort((values, groups))
+    values = values[order]
+
+    sizes = np.bincount(groups, minlength=n_groups)
+    starts = np.cumsum(sizes) - sizes
+    non_empty = sizes > 0
+    results = []
+    for q in quantiles:
+        result = np.full(n_groups, np.nan)
+        idx_val = q * (sizes[non_empty] - 1)
+        idx = idx_val.astype(np.int64)
+        frac = idx_val % 1
+        first = starts[non_empty] + idx
+        val = values[first]
+        next_val = values[
+            np.minimum(first + 1, starts[non_empty] + sizes[non_empty] - 1)
         ]
-        > 40
-    )
-    train["level_2"] = (
-        train.groupby(by=["brand", "model"]).transform("count")["raw_price"] > 40
-    )
-    train["level_3"] = train.groupby(by=["brand"]).transform("count")["raw_price"] > 40
+        result[non_empty] = np.where(frac == 0.0, val, val + (next_val - val) * frac)
+        results.append(result)
+    return results
+
+
+def hierarchical_outlier_mask(df, values, levels, count_col, min_count=40):
+    """
+    Flags IQR outliers of values within groups, each row being compared to the
+    most specific level of groups that holds more than min_count non missing
+    count_col values. The bounds of a level are computed on the rows assigned to
+    that level only. Rows no level applies to are never flagged.
+    :param df: dataframe holding the grouping columns, left untouched
+    :param values: float array aligned on df
+    :param levels: list of lists of grouping columns, most specific first
+    :return: boolean array aligned on df, True for outliers
+    """
+    counted = df[count_col].notna().to_numpy()
+    groups = np.full(len(df), -1, dtype=np.int64)
+    offset = 0
+    for group_cols in levels:
+        # Rows with a missing key get a NaN group number
+        codes = df.groupby(group_cols, sort=False, observed=True).ngroup()
+        codes = codes.fillna(-1).to_numpy(dtype=np.int64)
+        n_groups = codes.max() + 1
+        counts = np.bincount(codes[counted & (codes >= 0)], minlength=n_groups)
+        eligible = (groups < 0) & (codes >= 0)
+        eligible[eligible] = counts[codes[eligible]] > min_count
+        groups[eligible] = codes[eligible] + offset
+        offset += n_groups
+
+    Q1, Q3 = group_quantiles(groups, values, offset, [0.25, 0.75])
+    IQR = Q3 - Q1
+    lower_bound = np.append(Q1 - 1.5 * IQR, np.nan)[groups]
+    upper_bound = np.append(Q3 + 1.5 * IQR, np.nan)[groups]
+    return (values < lower_bound) | (values > upper_bound)
 
-    train["is_outlier"] = False
-    train[train.level_1] = detect_outlier_on_groups(
-        train[train.level_1], features_IQR, ["brand", "model", "registration_year"]
-    )
-    train[train.level_2 & ~(train.level_1)] = detect_outlier_on_groups(
-        train[train.level_2 & ~(train.level_1)], features_IQR, ["brand", "model"]
-    )
-    train[~(train.level_1 | train.level_2) & (train.level_3)] = (
-        detect_outlier_on_groups(
-            train[~(train.level_1 | train.level_2) & (train.level_3)],
-            features_IQR,
-            ["brand"],
-        )
+
+def remove_outliers(train):
+    """
+    Removes listings whose log price is an IQR outlier within their
+    brand/model/year group, falling back to brand/model then brand when the group
+    holds 40 prices or less, as well as listings with an abnormally low engine
+    size or power.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        raw_price_log = np.log(train["raw_price"].to_numpy(dtype=float))
+        engine_power_log = np.log(train["engine_power"] + 1e-10)
+    is_outlier = hierarchical_outlier_mask(
+        train,
+        raw_price_log,
+        [["brand", "model", "registration_year"], ["brand", "model"], ["brand"]],
+        count_col="raw_price",
     )
 
     engine_size_lower = compute_lower_bound(train["engine_size"])
-    engine_power_lower = np.exp(
-        compute_lower_bound(train["engine_power"].apply(lambda x: np.log(x + 1e-10)))
-    )
+    engine_power_lower = np.exp(compute_lower_bound(engine_power_log))
 
-    train["is_engine_outlier"] = (train.engine_power < engine_power_lower) | (
+    is_engine_outlier = (train.engine_power < engine_power_lower) | (
         train.engine_size < engine_size_lower
     )
-    train["is_outlier_final"] = train.is_outlier | train.is_engine_outlier
-    train = train[~train.is_outlier_final].copy()
-    train.drop(
-        columns=[
-            "raw_price_log",
-            "level_1",
-            "level_2",
-            "level_3",
-            "is_engine_outlier",
-            "is_outlier",
-            "is_outlier_final",
-        ],
-        inplace=True,
-    )
-    return train
-
-
-def impute_object_col_on_group(group):
-    if group.isna().sum() == group.shape[0]:
-        return np.nan
-    else:
-        return group.mode().iloc[0] if not group.mode().empty else np.nan
-
-
-def impute_num_on_group(group):
-    if group.isna().sum() == group.shape[0]:
-        return np.nan
-    else:
-        return group.mean()
-
-
-def impute_missing_values_on_feature(df, feature):
-    # if object select majority among group, for groups only with nan go one level higher
-    df = df.copy()
-    df = df.loc[:, ["brand", "model", "registration_year", feature]]
-
-    if (feature in ["seats", "doors", "number_of_gears", "rim_size"]) | (
-        df.loc[df[feature].notna(), feature].dtype
-        in ["object", "bool", "int64", "category"]
-    ):
-        print(f"imputing missing categorical values on {feature}")
-        df[f"mode_{feature}"] = df.groupby(["brand", "model", "registration_year"])[
-            feature
-        ].transform(impute_object_col_on_group)
-        df.loc[df[feature].isna(), feature] = df.loc[
-            df[feature].isna(), f"mode_{feature}"
-        ]
-
-        if df[feature].isna().sum() > 0:
-            df[f"mode_{feature}"] = df.groupby(["brand", "model"])[feature].transform(
-                impute_object_col_on_group
-            )
-            df.loc[df[feature].isna(), feature] = df.loc[
-                df[feature].isna(), f"mode_{feature}"
-            ]
-
-        if df[feature].isna().sum() > 0:
-            df[f"mode_{feature}"] = df.groupby(["brand", "model"])[feature].transform(
-                impute_object_col_on_group
-            )
-            df.loc[df[feature].isna(), feature] = df.loc[
-                df[feature].isna(), f"mode_{feature}"
-            ]
-
-        if df[feature].isna().sum() > 0:
-            df.loc[df[feature].isna(), feature] = df[feature].mode()[0]
-
-        if df[feature].eq(True).any():
-            df[feature] = df[feature].map({1.0: True, 0.0: False})
-            df[feature] = df[feature].astype(bool)
+    return train[~(is_outlier | is_engine_outlier.to_numpy())].copy()
 
-    else:
-        print(f"imputing numerical missing values on {feature}")
 
-        df[f"mean_{feature}"] = df.groupby(["brand", "model", "registration_year"])[
-            feature
-        ].transform(impute_num_on_group)
-        df.loc[df[feature].isna(), feature] = df.loc[
-            df[feature].isna(), f"mean_{feature}"
-        ]
+def processed_sets_key(train, test, strategy):
+    return f"{strategy}_{data_hash(train, test)}"
 
-        if df[feature].isna().sum() > 0:
-            df[f"mean_{feature}"] = df.groupby(["brand", "model"])[feature].transform(
-                impute_num_on_group
-            )
-            df.loc[df[feature].isna(), feature] = df.loc[
-                df[feature].isna(), f"mean_{feature}"
-            ]
 
-        if df[feature].isna().sum() > 0:
-            df[f"mean_{feature}"] = df.groupby(["brand", "model"])[feature].transform(
-                impute_num_on_group
-            )
-            df.loc[df[feature].isna(), feature] = df.loc[
-                df[feature].isna(), f"mean_{feature}"
-            ]
-        if df[feature].isna().sum() > 0:
-            df.loc[df[feature].isna(), feature] = df[feature].mean()
-    return df[feature]
-
-
-def preprocess_train_test(train, test, strategy):
+def preprocess_train_test(train, test, strategy, use_cache=True):
+    """
+    :param use_cache: reuse the processed sets cache when the data and
+    preprocessing didn't change, and save the processed sets to it
+    :return: the processed train and test sets of the strategy and the fitted
+    PreprocessingPipeline
+    """
     print(f"Preprocessing train test")
-    train, test = drop_unwanted_columns(train, test)
-    train = process_types(train)
-    test = process_types(test)
-    if strategy == "all_extras":
-        option_columns = [x for x in train.columns if "option" in x]
-        train = train.drop(columns=option_columns).copy()
-        test = test.drop(columns=option_columns).copy()
-        save_processed_set(train, f"processed_train_set_{strategy.upper()}.csv")
-        save_processed_set(test, f"processed_test_set_{strategy.upper()}.csv")
-
-    if strategy == "options":
-        extra_columns = [x for x in train.columns if "extra" in x]
-        train = train.drop(columns=extra_columns).copy()
-        test = test.drop(columns=extra_columns).copy()
-        save_processed_set(train, f"processed_train_set_{strategy.upper()}.csv")
-        save_processed_set(test, f"processed_test_set_{strategy.upper()}.csv")
-
+    if use_cache:
+        key = processed_sets_key(train, test, strategy)
+        cached = load_processed_sets(key)
+        if cached is not None:
+            return cached
+
+    pipeline = PreprocessingPipeline(strategy).fit(train, low_importances)
+    train_processed = pipeline.transform(train)
+    test_processed = pipeline.transform(test)
     if strategy == "remove_outliers":
-        rm_columns = [x for x in train.columns if "option" in x]
-        train = remove_outliers(train)
-        train.drop(columns=rm_columns, inplace=True)
-        test.drop(columns=rm_columns, inplace=True)
-        save_processed_set(train, f"processed_train_set_{strategy.upper()}.csv")
-        save_processed_set(test, f"processed_test_set_{strategy.upper()}.csv")
-
-    if strategy == "drop_extras_and_options":
-        rm_columns = [x for x in train.columns if "option" in x or "extra" in x]
-        train = train.drop(columns=rm_columns).copy()
-        test = test.drop(columns=rm_columns).copy()
-        save_processed_set(train, f"processed_train_set_{strategy.upper()}.csv")
-        save_processed_set(test, f"processed_test_set_{strategy.upper()}.csv")
-
-    if strategy in "drop_unpractical":
-        rm_columns = [
-            "kteo",
-            "emissions_co2",
-            "battery_charge_time",
-            "vehicle_width",
-            "vehicle_height",
-            "vehicle_length",
-            "wheelbase",
-            "torque",
-            "acceleration",
-            "number_of_gears",
-            "gross_weight",
-            "top_speed",
-            "fuel_consumption",
-            "registration_month",
-        ]
-        option_columns = [x for x in train.columns if "option" in x]
-        rm_columns = rm_columns + option_columns
-        train = train.drop(columns=rm_columns).copy()
-        test = test.drop(columns=rm_columns).copy()
-        save_processed_set(train, f"processed_train_set_{strategy.upper()}.csv")
-        save_processed_set(test, f"processed_test_set_{strategy.upper()}.csv")
-
-    if strategy == "drop_low_importance":
-        train = train.drop(columns=low_importances).copy()
-        test = test.drop(columns=low_importances).copy()
-        save_processed_set(train, f"processed_train_set_{strategy.upper()}.csv")
-        save_processed_set(test, f"processed_test_set_{strategy.upper()}.csv")
-
-    if strategy == "impute_missing_values":
-        rm_columns = ["kteo", "battery_charge_time"] + [
-            x for x in train.columns if "option" in x
-        ]
-        train = train.drop(columns=rm_columns).copy()
-        test = test.drop(columns=rm_columns).copy()
-        nan_cols_train = train.columns[train.isna().any()].tolist()
-        nan_cols_test = test.columns[train.isna().any()].tolist()
-        for feature in nan_cols_train:
-            train[feature] = impute_missing_values_on_feature(train, feature)
-        for feature in nan_cols_test:
-            test[feature] = impute_missing_values_on_feature(test, feature)
-    return train, test
+        train_processed = remove_outliers(train_processed)
+    if use_cache:
+        save_processed_sets(key, train_processed, test_processed, pipeline)
+    return train_processed, test_processed, pipeline
 
 
-def train_model(train, test, strategy):
-    print(f"Training model for strategy {strategy}")
-    train_processed, test_processed = preprocess_train_test(train, test, strategy)
-    monotonic_constraints = {"is_metallic": 1, "crashed": -1, "is_new": 1}
-    monotonic_constraints.update(
-        {x: 1 for x in train_processed.columns.tolist() if "extra" in x}
-    )
+def make_objective(strategy, fold_pools, task_type="GPU", thread_count=None):
+    """
+    :param thread_count: CatBoost threads of each fit, every core if None
+    """
 
     def objective(trial):
         print("Using common params")
@@ -398,35 +407,33 @@ def train_model(train, test, strategy):
                 "loss_function", ["RMSE", "Quantile:alpha=0.5"]
             ),
             "nan_mode": trial.suggest_categorical("nan_mode", ["Max"]),
-            "task_type": trial.suggest_categorical("task_type", ["GPU"]),
             "grow_policy": trial.suggest_categorical(
                 "grow_policy", ["Depthwise", "Lossguide"]
             ),
         }
-        print(f"Launching 4 fold cv for strategy {strategy}")
+        params = apply_profile(params, task_type, thread_count)
+        # Validation MAE computed while fitting, predicting on the quantized
+        # fold pools isn't supported with categorical features
+        params["custom_metric"] = "MAE:hints=skip_train~true"
+        print(f"Launching {len(fold_pools)} fold cv for strategy {strategy}")
         # cv_results = cv(train_pool, params = params, fold_count=4, verbose=True, early_stopping_rounds=50)
 
-        kf = ShuffleSplit(n_splits=3, test_size=0.2, random_state=42)
         cv_results = []
         best_iter = []
-        for fold, (train_index, val_index) in enumerate(kf.split(train_processed)):
+        for fold, (train_fold_pool, val_fold_pool, _) in enumerate(fold_pools):
             print(f"Launching fold {fold}")
-            train_fold = train_processed.iloc[train_index]
-            val_fold = train_processed.iloc[val_index]
-
-            train_fold_pool, val_fold_pool, y_train_fold, y_val_fold = (
-                get_train_val_test_pools(train_fold, val_fold, strategy)
-            )
             print(params)
             model = CatBoostRegressor(**params)
             model.fit(
                 train_fold_pool,
                 eval_set=val_fold_pool,
-                early_stopping_rounds=50,
+                early_stopping_rounds=(
+                    QUICK_EARLY_STOPPING_ROUNDS if QUICK else EARLY_STOPPING_ROUNDS
+                ),
                 verbose=50,
             )
-            y_pred = model.predict(val_fold_pool)
-            cv_results.append(mean_absolute_error(y_val_fold, y_pred))
+            val_mae = model.get_evals_result()["validation"]["MAE"]
+            cv_results.append(val_mae[model.get_best_iteration()])
             best_iter.append(model.get_best_iteration())
             print(f"Fold {fold} finished")
 
@@ -437,16 +444,276 @@ def train_model(train, test, strategy):
         trial.set_user_attr("best_iteration", max(best_iter))
         return np.mean(cv_results)
 
-    study = optuna.create_study(
-        direction="minimize", pruner=optuna.pruners.MedianPruner()
+    return objective
+
+
+def study_storage(path=STUDY_JOURNAL):
+    """
+    :return: the Optuna journal storage shared by the studies of every strategy,
+    safe to use from several processes
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return optuna.storages.JournalStorage(
+        optuna.storages.journal.JournalFileBackend(path)
+    )
+
+
+def load_study(strategy, storage):
+    """
+    :return: the study of the strategy, resumed with its finished trials if it
+    already exists in storage
+    """
+    return optuna.create_study(
+        study_name=f"catboost_{strategy}",
+        storage=storage,
+        direction="minimize",
+        pruner=optuna.pruners.MedianPruner(),
+        load_if_exists=True,
+    )
+
+
+def finished_trials(study):
+    states = (TrialState.COMPLETE, TrialState.PRUNED)
+    return len(study.get_trials(deepcopy=False, states=states))
+
+
+def requeue_interrupted_trials(study):
+    """
+    Fails the trials left running by a crashed process and queues their
+    parameters again. Only call it while no worker runs the study.
+    """
+    for trial in study.get_trials(deepcopy=False, states=(TrialState.RUNNING,)):
+        print(f"Requeuing trial {trial.number} of study {study.study_name}")
+        study.tell(trial.number, state=TrialState.FAIL)
+        study.enqueue_trial(trial.params)
+
+
+def machine_memory():
+    """
+    :return: the memory available to the process in bytes, the cgroup limit in
+    containers, the physical memory otherwise
+    """
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    for path in [
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ]:
+        try:
+            with open(path) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit():
+            memory = min(memory, int(limit))
+    return memory
+
+
+def cpu_profile(thread_count=None):
+    """
+    CatBoost parameters to train on the CPUs of this machine. A fit gets the
+    share of RAM_FRACTION of the memory its threads have of the cores, so
+    workers fitting at once stay within the machine. Machines with
+    few cores quantize features in fewer borders, and boosting is Plain, cheaper
+    than Ordered and the only one supporting the Depthwise and Lossguide grow
+    policies.
+    :param thread_count: threads of the fit, every core if None
+    """
+    cpus = os.cpu_count() or 1
+    thread_count = min(thread_count or cpus, cpus)
+    ram = machine_memory() * RAM_FRACTION * thread_count / cpus
+    return {
+        "task_type": "CPU",
+        "thread_count": thread_count,
+        "border_count": 254 if thread_count >= 16 else FOLD_BORDER_COUNT,
+        "used_ram_limit": f"{int(ram / 2**20)}mb",
+        "boosting_type": "Plain",
+    }
+
+
+def apply_profile(params, task_type, thread_count=None, quick=QUICK):
+    """
+    :param thread_count: CatBoost threads, every core if None
+    :param quick: cap the trees to QUICK_ITERATIONS for smoke runs
+    :return: a copy of params training on task_type, with the cpu_profile on CPU
+    """
+    params = dict(params)
+    if task_type == "CPU":
+        params.update(cpu_profile(thread_count))
+    else:
+        params["task_type"] = task_type
+        if thread_count is not None:
+            params["thread_count"] = thread_count
+    if quick:
+        params["iterations"] = min(
+            params.get("iterations", QUICK_ITERATIONS), QUICK_ITERATIONS
+        )
+    return params
+
+
+def fold_border_count(task_type, thread_count=None):
+    """
+    :return: the borders of the fold pools, those of the cpu_profile on CPU
+    """
+    if task_type == "CPU":
+        return cpu_profile(thread_count)["border_count"]
+    return FOLD_BORDER_COUNT
+
+
+def pack_thread_count(n_workers, task_type):
+    """
+    :return: the CatBoost threads of each of the n_workers fitting at once on
+    CPU so they share the cores without oversubscribing them, None on GPU
+    """
+    if task_type == "GPU":
+        return None
+    return max(1, (os.cpu_count() or 1) // n_workers)
+
+
+def optimize_study(
+    strategy,
+    fold_pools,
+    n_trials=N_TRIALS,
+    task_type="GPU",
+    thread_count=None,
+    storage_path=STUDY_JOURNAL,
+):
+    """
+    Runs trials of the study of the strategy until it has n_trials finished
+    trials, counting the ones of earlier runs and of the other workers.
+    """
+    study = load_study(strategy, study_storage(storage_path))
+    remaining = n_trials - finished_trials(study)
+    if remaining <= 0:
+        return study
+    study.optimize(
+        make_objective(strategy, fold_pools, task_type, thread_count),
+        n_trials=remaining,
+        callbacks=[
+            MaxTrialsCallback(n_trials, states=(TrialState.COMPLETE, TrialState.PRUNED))
+        ],
+    )
+    return study
+
+
+def study_worker(strategy, key, n_trials, task_type, thread_count, storage_path):
+    # Worker processes load the processed sets saved by run_studies
+    train_processed, _, _ = load_processed_sets(key)
+    fold_pools = build_fold_pools(
+        train_processed,
+        strategy,
+        border_count=fold_border_count(task_type, thread_count),
+    )
+    optimize_study(
+        strategy, fold_pools, n_trials, task_type, thread_count, storage_path
     )
-    study.optimize(objective, n_trials=30)
+    wait_for_uploads()
+
+
+def run_studies(
+    strategies,
+    n_trials=N_TRIALS,
+    n_workers=1,
+    task_type="GPU",
+    storage_path=STUDY_JOURNAL,
+):
+    """
+    Runs the studies of several strategies side by side with n_workers worker
+    processes per strategy pulling trials from the shared journal storage. A
+    study interrupted by a crash resumes where it stopped. On CPU the cores are
+    split between all the workers. The sets are preprocessed once per strategy
+    before the workers start.
+    """
+    storage = study_storage(storage_path)
+    for strategy in strategies:
+        requeue_interrupted_trials(load_study(strategy, storage))
+    thread_count = pack_thread_count(len(strategies) * n_workers, task_type)
+
+    train, test = load_train_test()
+    keys = {}
+    for strategy in strategies:
+        preprocess_train_test(train, test, strategy)
+        keys[strategy] = processed_sets_key(train, test, strategy)
+    del train, test
+
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(
+            target=study_worker,
+            args=(
+                strategy,
+                keys[strategy],
+                n_trials,
+                task_type,
+                thread_count,
+                storage_path,
+            ),
+            name=f"{strategy}_{k}",
+        )
+        for strategy in strategies
+        for k in range(n_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    # The processed sets were queued for upload before the workers started
+    wait_for_uploads()
+    failed = [worker.name for worker in workers if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Study workers {failed} failed")
+
+
+def train_model(
+    train,
+    test,
+    strategy,
+    n_trials=N_TRIALS,
+    task_type="GPU",
+    storage_path=STUDY_JOURNAL,
+    thread_count=None,
+    use_cache=True,
+):
+    """
+    Tunes the model of the strategy, resuming its study from storage_path, and
+    fits the final model with the best parameters. Trials already run by
+    run_studies aren't run again.
+    :param thread_count: CatBoost threads, every core if None
+    :param use_cache: use the processed sets cache, see preprocess_train_test
+    """
+    print(f"Training model for strategy {strategy}")
+    train_processed, test_processed, pipeline = preprocess_train_test(
+        train, test, strategy, use_cache
+    )
+    monotonic_constraints = {"is_metallic": 1, "crashed": -1, "is_new": 1}
+    monotonic_constraints.update(
+        {x: 1 for x in train_processed.columns.tolist() if "extra" in x}
+    )
+
+    study = load_study(strategy, study_storage(storage_path))
+    requeue_interrupted_trials(study)
+    if finished_trials(study) < n_trials:
+        thread_count = thread_count or pack_thread_count(1, task_type)
+        fold_pools = build_fold_pools(
+            train_processed,
+            strategy,
+            border_count=fold_border_count(task_type, thread_count),
+        )
+        study = optimize_study(
+            strategy,
+            fold_pools,
+            n_trials,
+            task_type,
+            thread_count,
+            storage_path,
+        )
 
     print(f"Best params found")
     best_params = study.best_params
     best_trial = study.best_trial
     best_iteration = best_trial.user_attrs["best_iteration"]
-    best_params["iterations"] = best_iteration
+    # best_iteration is 0-based, the final model keeps the trees up to it
+    best_params["iterations"] = best_iteration + 1
+    best_params = apply_profile(best_params, task_type, thread_count)
 
     final_model = CatBoostRegressor(**best_params)
     train_pool, test_pool, y_train, y_test = get_train_val_test_pools(
@@ -466,7 +733,7 @@ def train_model(train, test, strategy):
     print(f"Saving best model for strategy {strategy}")
     print(f"Saving results for strategy {strategy}")
 
-    save_model(final_model, f"catboost_{strategy}")
+    save_model(final_model, f"catboost_{strategy}", pipeline)
     # final_model.save_model(f"/content/drive/MyDrive/car_estimation/best_model_{strategy}.cbm")
 
     save_results(results, f"results_{strategy}")
@@ -474,19 +741,164 @@ def train_model(train, test, strategy):
     return results, final_model, best_params
 
 
-def launch_training():
-    train, test = load_train_test()
-    print(f"Train shape: {train.shape}")
-    print(f"Test shape: {test.shape}")
-    # train_model(train, test, "remove_outliers")
-    # train_model(train, test, "drop_extras_and_options")
-    # train_model(train,test,"drop_low_importance")
-    train_model(train, test, "all_extras")
-    # train_model(train, test, "options")
-    # train_model(train,test,"impute_missing_values")
+def evaluate_strategy(strategy, results, final_model, cv_mae, elapsed):
+    """
+    :return: a row of the comparison table of run_experiments
+    """
+    ape = results[f"ape_{strategy}"]
+    abs_residuals = results[f"abs_residuals_{strategy}"]
+    return {
+        "strategy": strategy,
+        "MAPE": ape.mean(),
+        "MedAPE": ape.median(),
+        "MAE": abs_residuals.mean(),
+        "MedAE": abs_residuals.median(),
+        "cv_MAE": cv_mae,
+        "features": len(final_model.feature_names_),
+        "trees": final_model.tree_count_,
+        "minutes": round(elapsed / 60, 1),
+    }
+
+
+def split_blocks(df):
+    """
+    Pandas copies the columns taken out of the 2D blocks of a consolidated
+    frame when they mix dtypes or aren't in block order, but only slices the
+    blocks of a frame holding one block per column.
+    :return: df with one block per column, sharing its data under Copy-on-Write
+    """
+    return pd.concat([df[[x]] for x in df.columns], axis=1)
+
+
+def run_experiments(
+    strategies=STRATEGIES,
+    n_workers=None,
+    n_trials=N_TRIALS,
+    task_type="GPU",
+    storage_path=STUDY_JOURNAL,
+):
+    """
+    Trains the models of several strategies and compares them. The train and
+    test sets are loaded and typed once and split in one block per column, so
+    with pandas Copy-on-Write every strategy selects its columns as views of
+    them instead of copies, see split_blocks. Strategies
+    are scheduled over n_workers threads, CatBoost releasing the GIL while
+    fitting, with the CPU cores split between the workers.
+    :param n_workers: strategies trained at once, 1 on GPU and as many as
+    strategies on CPU if None
+    :return: the comparison table, sorted by MAPE and saved as results
+    """
+    if n_workers is None:
+        n_workers = 1 if task_type == "GPU" else min(len(strategies), os.cpu_count())
+    thread_count = pack_thread_count(n_workers, task_type)
+
+    rows = []
+    with pd.option_context("mode.copy_on_write", True):
+        train, test = load_train_test()
+        train, test = process_types(train), process_types(test)
+        train, test = split_blocks(train), split_blocks(test)
+        print(f"Train shape: {train.shape}")
+        print(f"Test shape: {test.shape}")
+
+        def run(strategy):
+            start = time.monotonic()
+            results, final_model, _ = train_model(
+                train,
+                test,
+                strategy,
+                n_trials,
+                task_type,
+                storage_path,
+                thread_count,
+                use_cache=False,
+            )
+            study = load_study(strategy, study_storage(storage_path))
+            return evaluate_strategy(
+                strategy,
+                results,
+                final_model,
+                study.best_value,
+                time.monotonic() - start,
+            )
 
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(run, x): x for x in strategies}
+            for future in as_completed(futures):
+                try:
+                    rows.append(future.result())
+                except Exception as e:
+                    print(f"Strategy {futures[future]} failed: {e}")
+                    rows.append({"strategy": futures[future], "error": str(e)})
 
-def train_final_models():
+    comparison = pd.DataFrame(rows)
+    if "MAPE" in comparison.columns:
+        comparison = comparison.sort_values("MAPE").reset_index(drop=True)
+    print(comparison.to_string())
+    save_results(comparison, f"comparison_{time.strftime('%Y%m%d_%H%M%S')}")
+    return comparison
+
+
+def launch_training():
+    run_experiments(STRATEGIES)
+    wait_for_uploads()
+
+
+def quantile_metrics(y, predictions, quantiles=QUANTILES):
+    """
+    :param predictions: predictions of y, one column per quantile
+    :return: the pinball loss of every quantile, the coverage of the interval
+    between the first and last quantiles, the share of rows with crossing
+    quantiles and the MAPE of the median
+    """
+    y = np.asarray(y)[:, None]
+    alphas = np.array(quantiles)
+    errors = y - predictions
+    pinball = np.maximum(alphas * errors, (alphas - 1) * errors)
+    metrics = {f"pinball_{q}": loss for q, loss in zip(quantiles, pinball.mean(axis=0))}
+    y = y[:, 0]
+    metrics["coverage"] = np.mean((predictions[:, 0] <= y) & (y <= predictions[:, -1]))
+    metrics["crossing"] = np.mean(np.any(np.diff(predictions, axis=1) < 0, axis=1))
+    metrics["MAPE"] = mean_absolute_percentage_error(
+        y, predictions[:, quantiles.index(0.5)]
+    )
+    return metrics
+
+
+def compare_quantile_models(test_pool, y_test, candidates):
+    """
+    :param candidates: dict mapping a name to a single MultiQuantile model or to
+    the models of every quantile
+    :return: the quantile metrics and prediction time of every candidate on the
+    test set
+    """
+    rows = []
+    for name, models in candidates.items():
+        start = time.perf_counter()
+        predictions = predict_quantiles(models, test_pool)
+        elapsed = time.perf_counter() - start
+        rows.append(
+            {
+                "models": name,
+                **quantile_metrics(y_test, predictions),
+                "predict_seconds": elapsed,
+                "trees": sum(model.tree_count_ for model in models),
+            }
+        )
+    comparison = pd.DataFrame(rows)
+    print(comparison.to_string())
+    return comparison
+
+
+def train_final_models(multi_quantile=False, task_type="GPU"):
+    """
+    Trains the q1, q2 and q3 models of the app, three Quantile models.
+    :param multi_quantile: train a single MultiQuantile model predicting every
+    quantile in one pass instead, compared with the published three model
+    baseline on the test set. It is published as catboost_multiquantile, and
+    then served by the app, only if its mean pinball loss and the distance of
+    its coverage to the nominal one are no worse than the baseline's.
+    :param task_type: GPU, or CPU to train with the cpu_profile
+    """
     print("Creating training set...")
     train, test = load_train_test()
     # train_all = pd.concat([train, test], axis=0)
@@ -498,42 +910,167 @@ def train_final_models():
         "bagging_temperature": 0.8319957516,
         "grow_policy": "Depthwise",
         "l2_leaf_reg": 0.6747582331,
-        "task_type": "GPU",
         "depth": 9,
         "min_data_in_leaf": 92,
         "learning_rate": 0.02721930604,
     }
+    base_params = params
+    params = apply_profile(base_params, task_type)
     print(f"Parameters for training will be {params}")
 
     print("preprocessing training set")
-    train_all_processed, test_processed = preprocess_train_test(
+    train_all_processed, test_processed, pipeline = preprocess_train_test(
         train, test, "drop_unpractical"
     )
 
+    print("Getting training pool for training")
+    train_pool, test_pool, y_train_all, y_test = get_train_val_test_pools(
+        train_all_processed, test_processed, "drop_unpractical"
+    )
+
+    if multi_quantile:
+        print("Training model multiquantile")
+        multi_params = apply_profile(base_params, MULTI_QUANTILE_TASK_TYPE)
+        model = CatBoostRegressor(**multi_params, loss_function=MULTI_QUANTILE_LOSS)
+        model.fit(train_pool, verbose=50)
+        candidates = {"multiquantile": [model]}
+        try:
+            candidates["q1_q2_q3"] = [
+                load_model(f"catboost_{name}") for name in ["q1", "q2", "q3"]
+            ]
+        except FileNotFoundError:
+            print("Three model baseline not published, skipping the comparison")
+            passed = True
+        else:
+            comparison = compare_quantile_models(test_pool, y_test, candidates)
+            pinball = comparison.filter(like="pinball").mean(axis=1)
+            coverage_error = (comparison.coverage - NOMINAL_COVERAGE).abs()
+            comparison["passed"] = (pinball <= pinball.iloc[1]) & (
+                coverage_error <= coverage_error.iloc[1]
+            )
+            save_results(comparison, "comparison_quantile_models")
+            passed = comparison.passed.iloc[0]
+        if passed:
+            save_model(model, "catboost_multiquantile", pipeline)
+        else:
+            print(
+                "The MultiQuantile model is worse than the baseline, not publishing it"
+            )
+        wait_for_uploads()
+        return
+
     print("Initialising models")
     model_q1 = CatBoostRegressor(**params, loss_function="Quantile:alpha=0.25")
     model_q2 = CatBoostRegressor(**params, loss_function="Quantile:alpha=0.5")
     model_q3 = CatBoostRegressor(**params, loss_function="Quantile:alpha=0.75")
 
-    print("Getting training pool for training")
-    train_pool, _, y_train_all, _ = get_train_val_test_pools(
-        train_all_processed, test_processed, "drop_unpractical"
-    )
-
+    # Each model uploads while the next one trains
     print("Training model q1")
     model_q1.fit(train_pool, verbose=50)
+    save_model(model_q1, "catboost_q1", pipeline)
 
     print("Training model q2")
     model_q2.fit(train_pool, verbose=50)
+    save_model(model_q2, "catboost_q2", pipeline)
 
     print("Training model q3")
     model_q3.fit(train_pool, verbose=50)
-
-    print("Saving models")
-
-    save_model(model_q1, "catboost_q1")
-    save_model(model_q2, "catboost_q2")
-    save_model(model_q3, "catboost_q3")
+    save_model(model_q3, "catboost_q3", pipeline)
+
+    wait_for_uploads()
+
+
+def new_listings(listings, seen):
+    """
+    :param seen: the listings the models were trained on
+    :return: the listings absent from seen or changed since, compared on the
+    columns of seen, keeping the last version of every id
+    """
+    listings = listings.drop_duplicates("id", keep="last")
+    columns = [x for x in seen.columns if x in listings.columns]
+    seen_hashes = pd.util.hash_pandas_object(seen[columns], index=False)
+    hashes = pd.util.hash_pandas_object(listings[columns], index=False)
+    return listings[~hashes.isin(seen_hashes).to_numpy()]
+
+
+def model_pool(df, model):
+    """
+    :param df: processed listings with their raw_price
+    :return: the pool of df for the features of a trained model, with the
+    categorical features of the model rather than the ones inferred from the
+    dtypes of df, and the labels
+    """
+    X, y = df.reindex(columns=model.feature_names_), df["raw_price"]
+    categorical_features = model.get_cat_feature_indices()
+    X = fill_missing_categories(X, categorical_features)
+    return Pool(data=X, label=y, cat_features=categorical_features), y
+
+
+def retrain_incremental(
+    listings_set,
+    iterations=RETRAIN_ITERATIONS,
+    tolerance=RETRAIN_TOLERANCE,
+    thread_count=None,
+):
+    """
+    Refreshes the production models with the listings of listings_set they
+    weren't trained on, instead of training them again from scratch. Every
+    model keeps its trees (init_model) and adds at most iterations trees fitted
+    on those listings only, on CPU as CatBoost only continues a training there.
+    A regression gate compares the refreshed and current models on the held-out
+    test set: the refreshed ones are published only if their mean pinball loss
+    is within tolerance of the current one, and the listings are then added to
+    RETRAINED_SET so the next refresh skips them.
+    :param listings_set: typed set of listings in the schema of TRAIN_SET
+    :param thread_count: CatBoost threads, every core if None
+    :return: the gate report, saved as results, None without new listings
+    """
+    train, test = load_train_test()
+    try:
+        retrained = load_set(RETRAINED_SET)
+    except FileNotFoundError:
+        retrained = None
+    seen = train if retrained is None else pd.concat([train, retrained])
+    listings = load_set(listings_set)
+    fresh = new_listings(listings, seen)
+    # The test set stays held out for the gate
+    fresh = fresh[~fresh.id.isin(test.id)]
+    print(f"{len(fresh)} new or changed listings out of {len(listings)}")
+    if fresh.empty:
+        return None
+
+    names = production_model_names()
+    current = [load_model(f"catboost_{name}") for name in names]
+    # The models of the app share the pipeline they were trained with
+    pipeline = load_pipeline(f"catboost_{names[0]}")
+    fresh_pool, _ = model_pool(pipeline.transform(fresh), current[0])
+    test_pool, y_test = model_pool(pipeline.transform(test), current[0])
+
+    refreshed = []
+    for name, model in zip(names, current):
+        print(f"Refreshing model {name}")
+        params = dict(model.get_params(), iterations=iterations)
+        candidate = CatBoostRegressor(**apply_profile(params, "CPU", thread_count))
+        candidate.fit(fresh_pool, init_model=model, verbose=50)
+        refreshed.append(candidate)
+
+    report = compare_quantile_models(
+        test_pool, y_test, {"current": current, "refreshed": refreshed}
+    )
+    pinball = report.filter(like="pinball").mean(axis=1)
+    report["passed"] = pinball.iloc[1] <= pinball.iloc[0] * (1 + tolerance)
+    save_results(report, f"retrain_{time.strftime('%Y%m%d_%H%M%S')}")
+    if report.passed.iloc[1]:
+        for name, model in zip(names, refreshed):
+            save_model(model, f"catboost_{name}", pipeline)
+        retrained = fresh if retrained is None else pd.concat([retrained, fresh])
+        path = write_dataset(normalize_types(retrained), f"{RETRAINED_SET}.parquet")
+        get_artifact_publisher().publish(f"data/train_test_sets/{path}", path)
+        print(f"Published the models refreshed on {len(fresh)} listings")
+    else:
+        print("The refreshed models regress on the test set, keeping the current ones")
+    wait_for_uploads()
+    return report
 
 
 if __name__ == "__main__":